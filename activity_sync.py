@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+import httpx
+from db import database
+from strava_client import strava, StravaError
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Сколько дней до курсора перепроверяем, чтобы заметить изменённые и удалённые активности
+SYNC_LOOKBACK = int(os.environ.get('SYNC_LOOKBACK_DAYS', 7)) * 24 * 60 * 60
+# Первая синхронизация забирает только последние SYNC_INITIAL_DAYS дней (0 — всю историю):
+# у давних пользователей Strava полная выгрузка — тысячи запросов и сообщений
+SYNC_INITIAL_WINDOW = int(os.environ.get('SYNC_INITIAL_DAYS', 30)) * 24 * 60 * 60
+# Размер пачки активностей, записываемой в базу за один раз
+SYNC_BATCH_SIZE = 200
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def _to_timestamp(start_date):
+    return datetime.strptime(start_date, DATE_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _to_start_date(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime(DATE_FORMAT)
+
+
+# Инкрементальная синхронизация активностей одного пользователя.
+# Первый запуск выгружает последние SYNC_INITIAL_DAYS дней, последующие — только активности
+# после сохранённого курсора
+# (с небольшим перекрытием для сверки изменений и удалений).
+# run() отдаёт новые активности и известные, у которых прибавилось фотографий
+# (их прежнее число — known_photo_count); итоги доступны в new/updated/deleted.
+# Такая активность записывается в базу только после confirm(activity) — когда вызывающий
+# доставил её фотографии. Курсор и удаления фиксирует commit(); курсор не уходит дальше
+# самой ранней неподтверждённой активности, и следующий запуск отдаст её снова.
+class ActivitySync:
+    def __init__(self, user_id, access_token):
+        self.user_id = user_id
+        self.access_token = access_token
+        self.incremental = False
+        self.complete = False
+        self.new = 0
+        self.updated = 0
+        self.deleted = 0
+        self._known = {}
+        self._seen = set()
+        self._newest = None
+        self._batch = []
+        self._unconfirmed = {}
+
+    async def run(self):
+        cursor = await database.get_sync_cursor(self.user_id)
+        after = time.time() - SYNC_INITIAL_WINDOW if SYNC_INITIAL_WINDOW else None
+        if cursor:
+            self.incremental = True
+            after = _to_timestamp(cursor[0]) - SYNC_LOOKBACK
+        # Известные активности нужны и без курсора: прерванная первая синхронизация
+        # уже сохранила доставленные, и повторно их отправлять нельзя
+        since = _to_start_date(after) if after is not None else ""
+        self._known = await database.get_known_activities(self.user_id, since)
+
+        self._newest = tuple(cursor) if cursor else None
+        try:
+            async for activity in strava.iter_activities(self.access_token, after=after):
+                activity_id = activity["id"]
+                start_date = activity.get("start_date")
+                self._seen.add(activity_id)
+                row = (activity_id, start_date, activity.get("name"), activity.get("total_photo_count", 0))
+
+                previous = self._known.get(activity_id)
+                # Фотографии часто добавляют уже после загрузки активности
+                photos_added = previous is not None and (row[3] or 0) > (previous[1] or 0)
+                if previous is None:
+                    self.new += 1
+                    self._unconfirmed[activity_id] = row
+                elif photos_added:
+                    self.updated += 1
+                    self._unconfirmed[activity_id] = row
+                elif previous != row[2:]:
+                    self.updated += 1
+                    self._batch.append(row)
+
+                if start_date and (self._newest is None or (start_date, activity_id) > self._newest):
+                    self._newest = (start_date, activity_id)
+                if len(self._batch) >= SYNC_BATCH_SIZE:
+                    await self._flush()
+                if previous is None or photos_added:
+                    yield activity
+            self.complete = True
+        except (StravaError, httpx.HTTPError, CircuitOpenError) as e:
+            logger.error(
+                "Ошибка синхронизации активностей пользователя %s: %r", self.user_id, e,
+                extra={"user_id": self.user_id},
+            )
+
+    # Сколько фотографий было у активности при прошлой синхронизации (0 для новой)
+    def known_photo_count(self, activity):
+        previous = self._known.get(activity["id"])
+        return (previous[1] or 0) if previous else 0
+
+    # Фотографии активности доставлены — её можно запомнить
+    def confirm(self, activity):
+        row = self._unconfirmed.pop(activity["id"], None)
+        if row is not None:
+            self._batch.append(row)
+
+    async def _flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            await database.save_activities(self.user_id, batch)
+
+    async def commit(self):
+        await self._flush()
+        # Курсор и удаления фиксируем только после полной выгрузки окна
+        if self.complete:
+            deleted = set(self._known) - self._seen
+            if deleted:
+                await database.delete_activities(self.user_id, deleted)
+                self.deleted = len(deleted)
+            held = [(row[1], row[0]) for row in self._unconfirmed.values() if row[1]]
+            newest = min(held) if held else self._newest
+            if newest:
+                await database.set_sync_cursor(self.user_id, newest[0], newest[1], int(time.time()))
+
+        logger.info(
+            "Синхронизация пользователя %s: новых %s (не доставлено %s), изменённых %s, удалённых %s",
+            self.user_id, self.new, len(self._unconfirmed), self.updated, self.deleted,
+            extra={
+                "user_id": self.user_id, "activities_new": self.new, "activities_undelivered": len(self._unconfirmed),
+                "activities_updated": self.updated, "activities_deleted": self.deleted,
+            },
+        )
@@ -0,0 +1,83 @@
+# Микробенчмарк накладных расходов на одно обновление Telegram:
+# старый путь (application.initialize() на каждом вебхуке) против нового
+# (Application инициализирован один раз при старте).
+#
+# Запуск: python benchmarks/bench_application_lifecycle.py [число обновлений]
+import sys
+import json
+import time
+import asyncio
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+BOT_USER = {
+    "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+
+
+# Bot API без сети: на getMe отвечаем заготовкой, чтобы initialize() ничего не скачивал
+class OfflineRequest(BaseRequest):
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        return 200, json.dumps({"ok": True, "result": BOT_USER}).encode()
+
+
+def make_update(application, update_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "hello",
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "user"},
+        },
+    }, application.bot)
+
+
+async def noop(update, context):
+    pass
+
+
+def build_application():
+    application = Application.builder().token("1:bench").request(OfflineRequest()).build()
+    application.add_handler(MessageHandler(filters.TEXT, noop))
+    return application
+
+
+async def run(per_update_initialize):
+    application = build_application()
+    updates = [make_update(application, i) for i in range(UPDATES)]
+    if not per_update_initialize:
+        await application.initialize()
+
+    started = time.perf_counter()
+    for update in updates:
+        if per_update_initialize:
+            await application.initialize()
+        await application.process_update(update)
+    elapsed = time.perf_counter() - started
+
+    await application.shutdown()
+    return elapsed / UPDATES * 1e6
+
+
+async def main():
+    before = await run(per_update_initialize=True)
+    after = await run(per_update_initialize=False)
+    print(f"Обновлений: {UPDATES}")
+    print(f"initialize() на каждом вебхуке: {before:.2f} мкс/обновление")
+    print(f"initialize() один раз при старте: {after:.2f} мкс/обновление")
+    print(f"Экономия: {before - after:.2f} мкс/обновление ({(1 - after / before) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,331 @@
+# Сквозной бенчмарк вебхука Telegram и OAuth-цепочки Strava на фейковых сервисах.
+#
+# Поднимает benchmarks/fake_upstreams.py отдельным процессом, направляет на него бота
+# и гоняет через Quart-приложение два сценария:
+#   oauth   — /strava_callback для --users новых пользователей: время ответа (обмен кода
+#             и профиль) и пропускная способность фоновой первой синхронизации
+#             с отправкой фотографий (process_activities) при лимите Telegram на чат;
+#   webhook — /start через /webhook для --updates пользователей: время ответа вебхука
+#             и пропускная способность обработки очереди.
+# По каждому сценарию: пропускная способность, p50/p95/p99 задержки, задержка event loop
+# и число исходящих вызовов по эндпоинтам. Результаты пишутся в JSON (--output);
+# с --baseline результаты сравниваются с сохранённым эталоном, регрессии дают код выхода 1,
+# запуск с другими параметрами, чем у эталона, — код 2.
+#
+# Запуск: python benchmarks/bench_e2e.py --users 1000 --baseline benchmarks/e2e_baseline.json
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_UPSTREAMS = os.path.join(ROOT, "benchmarks", "fake_upstreams.py")
+LOOP_LAG_INTERVAL = 0.01
+
+# Что сравнивается с эталоном: путь в результатах сценария и направление "хуже"
+REGRESSION_CHECKS = [
+    (("throughput_rps",), "lower"),
+    (("latency_ms", "p95"), "higher"),
+    (("latency_ms", "p99"), "higher"),
+    (("loop_lag_ms", "p99"), "higher"),
+    (("outbound_per_user",), "higher"),
+]
+# Параметры запуска, не влияющие на сравнимость с эталоном
+CONFIG_NOT_COMPARED = ("scenarios", "tolerance")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк вебхука и OAuth-цепочки")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в сценарии oauth")
+    parser.add_argument("--updates", type=int, default=5000, help="обновлений в сценарии webhook")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных входящих запросов")
+    parser.add_argument("--activities", type=int, default=10, help="активностей у пользователя")
+    parser.add_argument("--photos", type=int, default=5, help="фотографий в активности с фото")
+    parser.add_argument("--photo-every", type=int, default=1, help="фото есть у каждой N-й активности")
+    parser.add_argument("--latency-ms", type=float, default=20, help="задержка фейковых сервисов")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--scenarios", default="oauth,webhook")
+    parser.add_argument("--output", default="e2e_results.json")
+    parser.add_argument("--baseline", help="JSON с эталонными результатами для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логов бота во время замеров")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def rank(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 2)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(values[-1], 2)}
+
+
+# Фейковые Strava и Telegram в отдельном процессе, чтобы не делить с ботом event loop
+def start_fake_upstreams(args, port):
+    command = [
+        sys.executable, FAKE_UPSTREAMS, "--port", str(port),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate), "--activities", str(args.activities),
+        "--photos", str(args.photos), "--photo-every", str(args.photo_every),
+        "--short-limit", "1000000", "--long-limit", "10000000",
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/_stats", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Фейковые сервисы не запустились")
+
+
+# Окружение бота: адреса фейков и лимиты, не ограничивающие замер.
+# Лимит Telegram на чат (1 сообщение в секунду) оставляем настоящим: на нём держится
+# время первой синхронизации каждого пользователя.
+def configure_environment(port, database_path):
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "STRAVA_API_URL": f"{base}/api/v3",
+        "STRAVA_OAUTH_URL": f"{base}/oauth/token",
+        "TELEGRAM_API_URL": base,
+        "DATABASE_PATH": database_path,
+    })
+    for name, value in {
+        "TELEGRAM_TOKEN": "123456:bench",
+        "WEBHOOK_URL": "http://bench.local",
+        "STRAVA_CLIENT_ID": "1",
+        "STRAVA_CLIENT_SECRET": "bench-secret",
+        "STRAVA_SHORT_LIMIT": "1000000",
+        "STRAVA_LONG_LIMIT": "10000000",
+        "STRAVA_BURST": "1000",
+        "TELEGRAM_GLOBAL_RATE": "100000",
+        "WEBHOOK_QUEUE_SIZE": "100000",
+        "SYNC_QUEUE_SIZE": "100000",
+        "SYNC_WORKERS": "100",
+    }.items():
+        os.environ.setdefault(name, value)
+
+
+# Задержка event loop: насколько позже запланированного просыпается короткий sleep
+class LoopLagMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append((time.perf_counter() - started - self.interval) * 1000)
+
+    def __enter__(self):
+        self.samples = []
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+
+
+def outbound_calls(base):
+    stats = httpx.get(f"{base}/_stats").json()
+    httpx.post(f"{base}/_reset")
+    return stats
+
+
+async def run_requests(count, concurrency, make_request):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one(index):
+        async with semaphore:
+            started = time.perf_counter()
+            status = await make_request(index)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    await asyncio.gather(*(one(index) for index in range(count)))
+    return latencies, statuses
+
+
+def scenario_result(count, duration, latencies, statuses, lag, outbound, users):
+    total = sum(outbound.values())
+    return {
+        "requests": count,
+        "statuses": {str(status): number for status, number in sorted(statuses.items())},
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(count / duration, 2),
+        "latency_ms": percentiles(latencies),
+        "loop_lag_ms": percentiles(lag.samples),
+        "outbound": outbound,
+        "outbound_total": total,
+        "outbound_per_user": round(total / users, 2),
+    }
+
+
+async def oauth_scenario(main, client, args, base):
+    from oauth_state import sign_state
+
+    async def callback(index):
+        user_id = 1000 + index
+        response = await client.get(f"/strava_callback?code=code-{user_id}&state={sign_state(user_id)}")
+        return response.status_code
+
+    with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        latencies, statuses = await run_requests(args.users, args.concurrency, callback)
+        await main.sync_queue.join()
+        duration = time.perf_counter() - started
+    return scenario_result(args.users, duration, latencies, statuses, lag, outbound_calls(base), args.users)
+
+
+def start_update(update_id, user_id):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "from": user, "chat": {"id": user_id, "type": "private"},
+        },
+    }
+
+
+async def webhook_scenario(main, client, args, base):
+    async def webhook(index):
+        response = await client.post("/webhook", json=start_update(index + 1, 500000 + index))
+        return response.status_code
+
+    with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        latencies, statuses = await run_requests(args.updates, args.concurrency, webhook)
+        await main.update_queue.join()
+        duration = time.perf_counter() - started
+    return scenario_result(args.updates, duration, latencies, statuses, lag, outbound_calls(base), args.updates)
+
+
+SCENARIOS = {"oauth": oauth_scenario, "webhook": webhook_scenario}
+
+
+async def run_benchmark(args, base):
+    import main
+
+    logging.getLogger().setLevel(args.log_level)
+    results = {}
+    async with main.app.test_app() as test_app:
+        client = test_app.test_client()
+        outbound_calls(base)  # Не учитываем getMe при старте
+        for name in args.scenarios.split(","):
+            results[name] = await SCENARIOS[name](main, client, args, base)
+    return results
+
+
+def get_path(data, path):
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+# Отличия конфигурации запуска от эталонной: с другими параметрами числа несравнимы
+def config_mismatches(config, baseline_config):
+    return [
+        f"{key}: {baseline_config.get(key)} -> {config.get(key)}"
+        for key in sorted(set(config) | set(baseline_config))
+        if key not in CONFIG_NOT_COMPARED and config.get(key) != baseline_config.get(key)
+    ]
+
+
+# Сравнение с эталоном: список описаний регрессий
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, current in results["scenarios"].items():
+        reference = baseline.get("scenarios", {}).get(scenario)
+        if reference is None:
+            continue
+        for path, worse in REGRESSION_CHECKS:
+            value, expected = get_path(current, path), get_path(reference, path)
+            if value is None or not expected:
+                continue
+            change = (value - expected) / expected
+            if (worse == "higher" and change > tolerance) or (worse == "lower" and -change > tolerance):
+                regressions.append(f"{scenario}.{'.'.join(path)}: {expected} -> {value} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    configure_environment(port, os.path.join(workdir, "bench.db"))
+    sys.path.insert(0, ROOT)
+
+    fake = start_fake_upstreams(args, port)
+    try:
+        scenarios = asyncio.run(run_benchmark(args, base))
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    results = {
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    for name, result in scenarios.items():
+        print(
+            f"{name}: {result['requests']} запросов за {result['duration_s']} с, "
+            f"{result['throughput_rps']} rps, задержка {result['latency_ms']}, "
+            f"лаг loop {result['loop_lag_ms']}, исходящих вызовов {result['outbound_total']} "
+            f"({result['outbound_per_user']} на пользователя), статусы {result['statuses']}"
+        )
+    print(f"Результаты записаны в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatches = config_mismatches(results["config"], baseline.get("config", {}))
+        if mismatches:
+            print("Конфигурация отличается от эталонной, сравнение невозможно:")
+            for mismatch in mismatches:
+                print(f"  {mismatch}")
+            sys.exit(2)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Регрессии относительно эталона:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("Регрессий относительно эталона нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Микробенчмарк стоимости логирования на один /strava_callback:
+# старый вариант (полный JSON фотографий и токены на INFO, каждый запрос httpx на INFO)
+# против нового (сводки на DEBUG с отложенным форматированием, маскирование токенов,
+# фильтры RedactingFilter/RepeatFilter, httpx на WARNING).
+#
+# Запуск: python benchmarks/bench_logging.py [число запросов]
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safe_logging import RedactingFilter, RepeatFilter, Lazy, mask, summarize  # noqa: E402
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+ACTIVITIES = 10
+PHOTOS_PER_ACTIVITY = 5
+BOT_TOKEN = "7311543449:AAFY5nVhOwRJEbnJLHkTMskMFsGzXrKasXo"
+ACCESS_TOKEN = "a" * 40
+REFRESH_TOKEN = "r" * 40
+FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+
+# Фотография в том виде, в каком её отдаёт Strava
+def make_photo(activity_id, index):
+    url = f"https://dgtzuqphqg23d.cloudfront.net/{activity_id}-{index}-abcdefghijklmnopqrstuvwxyz"
+    return {
+        "unique_id": f"{activity_id}-{index}-0a1b2c3d-4e5f-6a7b-8c9d-0e1f2a3b4c5d",
+        "activity_id": activity_id,
+        "activity_name": "Утренний забег",
+        "resource_state": 2,
+        "caption": "",
+        "source": 1,
+        "uploaded_at": "2024-05-01T07:30:00Z",
+        "created_at": "2024-05-01T07:30:00Z",
+        "created_at_local": "2024-05-01T10:30:00Z",
+        "urls": {"100": f"{url}-128x96.jpg", "600": f"{url}-768x576.jpg"},
+        "sizes": {"100": [128, 96], "600": [768, 576]},
+        "location": [55.7558, 37.6173],
+        "default_photo": index == 0,
+        "status": 3,
+    }
+
+
+ACTIVITY_PHOTOS = [
+    (activity_id, [make_photo(activity_id, index) for index in range(PHOTOS_PER_ACTIVITY)])
+    for activity_id in range(11000000000, 11000000000 + ACTIVITIES)
+]
+
+
+# Поток, считающий записанные байты и ничего не хранящий
+class CountingStream:
+    def __init__(self):
+        self.bytes = 0
+        self.text = ""
+
+    def write(self, text):
+        self.bytes += len(text.encode())
+        self.text = text  # последняя запись — для проверки утечек
+
+    def flush(self):
+        pass
+
+
+def make_loggers(name, new):
+    stream = CountingStream()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    if new:
+        handler.addFilter(RepeatFilter())
+        handler.addFilter(RedactingFilter())
+    loggers = []
+    for suffix in ("main", "httpx"):
+        logger = logging.getLogger(f"{name}.{suffix}")
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        loggers.append(logger)
+    if new:
+        loggers[1].setLevel(logging.WARNING)
+    return stream, loggers
+
+
+def request_old(logger, httpx_logger):
+    logger.info(f"Получен код: {'c' * 40}")
+    logger.info(f"Получен state: 42.1714550000.nonce.{'s' * 43}")
+    httpx_logger.info('HTTP Request: POST https://www.strava.com/oauth/token "HTTP/1.1 200 OK"')
+    logger.info(f"Получен новый access_token: {ACCESS_TOKEN}")
+    logger.info(f"Получен refresh_token: {REFRESH_TOKEN}")
+    for activity_id, photos in ACTIVITY_PHOTOS:
+        httpx_logger.info(
+            f'HTTP Request: GET https://www.strava.com/api/v3/activities/{activity_id}/photos "HTTP/1.1 200 OK"'
+        )
+        logger.info(f"Полученные фотографии для активности {activity_id}: {photos}")
+        httpx_logger.info(f'HTTP Request: POST https://api.telegram.org/bot{BOT_TOKEN}/sendMediaGroup "HTTP/1.1 200 OK"')
+
+
+def request_new(logger, httpx_logger):
+    logger.info(f"Обратный вызов Strava: code {mask('c' * 40)}")
+    httpx_logger.info('HTTP Request: POST https://www.strava.com/oauth/token "HTTP/1.1 200 OK"')
+    logger.info(
+        f"Получены токены Strava пользователя 42: access {mask(ACCESS_TOKEN)}, "
+        f"refresh {mask(REFRESH_TOKEN)}, действуют до 1714571600"
+    )
+    for activity_id, photos in ACTIVITY_PHOTOS:
+        httpx_logger.info(
+            f'HTTP Request: GET https://www.strava.com/api/v3/activities/{activity_id}/photos "HTTP/1.1 200 OK"'
+        )
+        logger.debug("Фотографии активности %s: %s", activity_id, Lazy(summarize, photos, "unique_id"))
+        httpx_logger.info(f'HTTP Request: POST https://api.telegram.org/bot{BOT_TOKEN}/sendMediaGroup "HTTP/1.1 200 OK"')
+
+
+def measure(name, request, new):
+    stream, (logger, httpx_logger) = make_loggers(name, new)
+    request(logger, httpx_logger)  # прогрев
+    stream.bytes = 0
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        request(logger, httpx_logger)
+    elapsed = time.perf_counter() - started
+    return elapsed / REQUESTS * 1e6, stream.bytes / REQUESTS
+
+
+# Одно сообщение с секретами через новые фильтры: что в итоге попадает в лог
+def leaked_secrets():
+    stream, (logger, httpx_logger) = make_loggers("bench.leak", new=True)
+    httpx_logger.setLevel(logging.INFO)
+    logger.warning(f"Ответ: {{'access_token': '{ACCESS_TOKEN}', 'refresh_token': '{REFRESH_TOKEN}'}}")
+    text = stream.text
+    httpx_logger.info(f"HTTP Request: POST https://api.telegram.org/bot{BOT_TOKEN}/sendMessage")
+    text += stream.text
+    return [secret for secret in (ACCESS_TOKEN, REFRESH_TOKEN, BOT_TOKEN) if secret in text]
+
+
+if __name__ == "__main__":
+    old_us, old_bytes = measure("bench.old", request_old, new=False)
+    new_us, new_bytes = measure("bench.new", request_new, new=True)
+    print(f"{ACTIVITIES} активностей по {PHOTOS_PER_ACTIVITY} фото, {REQUESTS} запросов")
+    print(f"старое логирование: {old_us:8.1f} мкс/запрос, {old_bytes:8.0f} байт/запрос")
+    print(f"новое логирование:  {new_us:8.1f} мкс/запрос, {new_bytes:8.0f} байт/запрос")
+    print(f"ускорение: {old_us / new_us:.1f}x, объём логов меньше в {old_bytes / max(new_bytes, 1):.1f} раз")
+    print(f"секреты в выводе после фильтров: {leaked_secrets() or 'нет'}")
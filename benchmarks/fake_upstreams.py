@@ -0,0 +1,228 @@
+# Локальная замена Strava API и Telegram Bot API для нагрузочного тестирования без сети.
+#
+# Запуск: python benchmarks/fake_upstreams.py --port 8081 --latency-ms 50 --error-rate 0.01
+# Приложение направляется сюда переменными окружения:
+#   STRAVA_API_URL=http://127.0.0.1:8081/api/v3
+#   STRAVA_OAUTH_URL=http://127.0.0.1:8081/oauth/token
+#   TELEGRAM_API_URL=http://127.0.0.1:8081
+#
+# Данные детерминированы: код авторизации "code-<athlete_id>" даёт токен "token-<athlete_id>",
+# у каждого атлета --activities активностей, у каждой --photo-every-й по --photos фотографий.
+# Счётчики вызовов по эндпоинтам: GET /_stats, сброс: POST /_reset.
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+from quart import Quart, request, jsonify
+
+# Время самой новой активности — начало часа запуска фейка, чтобы активности попадали
+# в окно первой синхронизации бота
+BASE_TIME = int(time.time()) // 3600 * 3600
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Фейковые Strava и Telegram для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="средняя задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="разброс задержки")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля ответов 5xx")
+    parser.add_argument("--activities", type=int, default=50, help="активностей у каждого атлета")
+    parser.add_argument("--photos", type=int, default=3, help="фотографий в активности с фото")
+    parser.add_argument("--photo-every", type=int, default=2, help="фото есть у каждой N-й активности")
+    parser.add_argument("--short-limit", type=int, default=600, help="лимит Strava на 15 минут")
+    parser.add_argument("--long-limit", type=int, default=30000, help="суточный лимит Strava")
+    parser.add_argument("--enforce-limits", action="store_true", help="отвечать 429 при превышении лимита")
+    parser.add_argument("--telegram-chat-rate", type=float, default=0,
+                        help="сообщений в секунду на чат, сверх — 429 retry_after (0 — без ограничения)")
+    return parser.parse_args(argv)
+
+
+def create_app(config):
+    app = Quart(__name__)
+    stats = Counter()
+    usage = {"short_window": 0, "short": 0, "long_window": 0, "long": 0}
+    chat_last_sent = {}
+    message_ids = iter(range(1, sys.maxsize))
+
+    async def simulate_latency():
+        delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+    def failed():
+        return config.error_rate and random.random() < config.error_rate
+
+    # Учёт квоты Strava по окнам, как в заголовках X-RateLimit-*
+    def rate_limit_headers():
+        now = time.time()
+        short_window, long_window = int(now // SHORT_WINDOW), int(now // LONG_WINDOW)
+        if usage["short_window"] != short_window:
+            usage["short_window"], usage["short"] = short_window, 0
+        if usage["long_window"] != long_window:
+            usage["long_window"], usage["long"] = long_window, 0
+        usage["short"] += 1
+        usage["long"] += 1
+        headers = {
+            "X-RateLimit-Limit": f"{config.short_limit},{config.long_limit}",
+            "X-RateLimit-Usage": f"{usage['short']},{usage['long']}",
+        }
+        exceeded = usage["short"] > config.short_limit or usage["long"] > config.long_limit
+        return headers, exceeded
+
+    def athlete_id_from_token():
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        try:
+            return int(token.rsplit("-", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def activity(athlete_id, index):
+        has_photos = index % config.photo_every == 0
+        return {
+            "id": athlete_id * 1000000 + index,
+            "name": f"Активность {index}",
+            "start_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(BASE_TIME - index * 3600)),
+            "total_photo_count": config.photos if has_photos else 0,
+        }
+
+    # Общая обёртка для эндпоинтов Strava: счётчик, задержка, ошибки и лимиты
+    async def strava_response(name, make_body):
+        stats[name] += 1
+        await simulate_latency()
+        headers, exceeded = rate_limit_headers()
+        if exceeded and config.enforce_limits:
+            return jsonify({"message": "Rate Limit Exceeded"}), 429, headers
+        if failed():
+            return jsonify({"message": "Server Error"}), 503, headers
+        if athlete_id_from_token() is None:
+            return jsonify({"message": "Authorization Error"}), 401, headers
+        return jsonify(make_body()), 200, headers
+
+    @app.get("/api/v3/athlete")
+    async def athlete():
+        return await strava_response("strava:/athlete", lambda: {
+            "id": athlete_id_from_token(), "firstname": "Fake", "lastname": f"Athlete{athlete_id_from_token()}",
+        })
+
+    @app.get("/api/v3/athlete/activities")
+    async def activities():
+        def body():
+            athlete_id = athlete_id_from_token()
+            page = int(request.args.get("page", 1))
+            per_page = int(request.args.get("per_page", 30))
+            after = int(request.args.get("after", 0))
+            before = int(request.args.get("before", sys.maxsize))
+            indexes = [
+                index for index in range(config.activities)
+                if after < BASE_TIME - index * 3600 < before
+            ]
+            window = indexes[(page - 1) * per_page:page * per_page]
+            return [activity(athlete_id, index) for index in window]
+        return await strava_response("strava:/athlete/activities", body)
+
+    @app.get("/api/v3/activities/<int:activity_id>/photos")
+    async def photos(activity_id):
+        return await strava_response("strava:/activities/{id}/photos", lambda: [
+            {
+                "unique_id": f"{activity_id}-{index}",
+                "urls": {"600": f"https://fake-photos.local/{activity_id}/{index}.jpg"},
+            }
+            for index in range(config.photos)
+        ])
+
+    @app.post("/oauth/token")
+    async def oauth_token():
+        stats["strava:/oauth/token"] += 1
+        await simulate_latency()
+        if failed():
+            return jsonify({"message": "Server Error"}), 503
+        form = await request.form
+        field = "code" if form.get("grant_type") == "authorization_code" else "refresh_token"
+        try:
+            athlete_id = int(form.get(field).rsplit("-", 1)[1])
+        except (AttributeError, IndexError, ValueError):
+            error = {"resource": "AuthorizationCode" if field == "code" else "RefreshToken",
+                     "field": field, "code": "invalid"}
+            return jsonify({"message": "Bad Request", "errors": [error]}), 400
+        return jsonify({
+            "token_type": "Bearer",
+            "access_token": f"token-{athlete_id}",
+            "refresh_token": f"refresh-{athlete_id}",
+            "expires_at": int(time.time()) + 6 * 60 * 60,
+            "athlete": {"id": athlete_id},
+        })
+
+    def telegram_message(chat_id, photo=None):
+        message = {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+        if photo is not None:
+            message["photo"] = [{
+                "file_id": f"file-{abs(hash(photo))}",
+                "file_unique_id": f"unique-{abs(hash(photo))}",
+                "width": 600, "height": 400,
+            }]
+        return message
+
+    @app.post("/bot<token>/<method>")
+    async def telegram(token, method):
+        stats[f"telegram:{method}"] += 1
+        await simulate_latency()
+        if failed():
+            return jsonify({"ok": False, "error_code": 502, "description": "Bad Gateway"}), 502
+        form = await request.form
+        chat_id = form.get("chat_id")
+
+        if config.telegram_chat_rate and chat_id is not None:
+            now = time.monotonic()
+            interval = 1 / config.telegram_chat_rate
+            last = chat_last_sent.get(chat_id)
+            if last is not None and now - last < interval:
+                stats["telegram:429"] += 1
+                return jsonify({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": 1},
+                }), 429
+            chat_last_sent[chat_id] = now
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method in ("setWebhook", "deleteWebhook"):
+            result = True
+        elif method == "sendMessage":
+            result = telegram_message(chat_id)
+        elif method == "sendPhoto":
+            result = telegram_message(chat_id, photo=form.get("photo"))
+        elif method == "sendMediaGroup":
+            media = json.loads(form.get("media", "[]"))
+            result = [telegram_message(chat_id, photo=item.get("media")) for item in media]
+        else:
+            return jsonify({"ok": False, "error_code": 404, "description": "Not Found"}), 404
+        return jsonify({"ok": True, "result": result})
+
+    @app.get("/_stats")
+    async def get_stats():
+        return jsonify(dict(stats))
+
+    @app.post("/_reset")
+    async def reset_stats():
+        stats.clear()
+        chat_last_sent.clear()
+        return jsonify({"status": "ok"})
+
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    create_app(args).run(host=args.host, port=args.port)
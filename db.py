@@ -0,0 +1,339 @@
+import os
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'users.db')
+# Число соединений для чтения; запись всегда идёт через одно соединение
+DB_READERS = int(os.environ.get('DB_READERS', 4))
+# Максимум операций записи в одной транзакции
+DB_WRITE_BATCH = int(os.environ.get('DB_WRITE_BATCH', 100))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users
+    (user_id INTEGER PRIMARY KEY, access_token TEXT, refresh_token TEXT);
+CREATE TABLE IF NOT EXISTS likes
+    (user_id INTEGER, activity_id TEXT, PRIMARY KEY (user_id, activity_id));
+CREATE TABLE IF NOT EXISTS sync_state
+    (user_id INTEGER PRIMARY KEY, last_start_date TEXT, last_activity_id INTEGER, synced_at INTEGER);
+CREATE TABLE IF NOT EXISTS activities
+    (user_id INTEGER, activity_id INTEGER, start_date TEXT, name TEXT, total_photo_count INTEGER,
+     PRIMARY KEY (user_id, activity_id));
+CREATE INDEX IF NOT EXISTS activities_start_date ON activities (user_id, start_date);
+CREATE TABLE IF NOT EXISTS photo_file_ids
+    (unique_id TEXT PRIMARY KEY, file_id TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS http_cache
+    (key TEXT PRIMARY KEY, scope TEXT, path TEXT, body TEXT NOT NULL, size INTEGER NOT NULL,
+     expires_at REAL NOT NULL, accessed_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS http_cache_accessed_at ON http_cache (accessed_at);
+"""
+
+# Колонки, добавленные к существующим таблицам после первой версии users.db
+MIGRATIONS = {
+    "users": [("expires_at", "INTEGER"), ("athlete_id", "INTEGER"), ("refresh_claimed_until", "INTEGER")],
+}
+# Индексы по мигрированным колонкам создаются после миграций
+INDEXES = """
+CREATE INDEX IF NOT EXISTS users_expires_at ON users (expires_at);
+CREATE INDEX IF NOT EXISTS users_athlete_id ON users (athlete_id);
+"""
+
+# SQL-запросы — константы: sqlite3 кэширует скомпилированные выражения на соединении,
+# поэтому повторные вызовы не разбирают SQL заново.
+SELECT_USER = "SELECT user_id, access_token, refresh_token, expires_at FROM users WHERE user_id = ?"
+UPSERT_USER = (
+    "INSERT INTO users (user_id, access_token, refresh_token, expires_at, athlete_id) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET access_token = excluded.access_token, "
+    "refresh_token = excluded.refresh_token, expires_at = excluded.expires_at, "
+    "athlete_id = COALESCE(excluded.athlete_id, users.athlete_id), refresh_claimed_until = NULL"
+)
+SELECT_USER_BY_ATHLETE = "SELECT user_id FROM users WHERE athlete_id = ?"
+# Данные пользователя, удаляемые при отзыве доступа в Strava
+DELETE_USER_DATA = [
+    "DELETE FROM users WHERE user_id = ?",
+    "DELETE FROM sync_state WHERE user_id = ?",
+    "DELETE FROM activities WHERE user_id = ?",
+    "DELETE FROM http_cache WHERE scope = CAST(? AS TEXT)",
+]
+SELECT_EXPIRING_USERS = (
+    "SELECT user_id, expires_at FROM users WHERE refresh_token IS NOT NULL AND expires_at < ? "
+    "AND COALESCE(refresh_claimed_until, 0) < ? ORDER BY expires_at"
+)
+# Захват обновления токена: из нескольких процессов строку изменит только один,
+# пока не истечёт его срок захвата или не сменится refresh_token
+CLAIM_TOKEN_REFRESH = (
+    "UPDATE users SET refresh_claimed_until = ? WHERE user_id = ? AND refresh_token = ? "
+    "AND COALESCE(refresh_claimed_until, 0) < ?"
+)
+# Условие на refresh_token: не затираем токен, полученный за это время новой авторизацией
+CLEAR_REFRESH_TOKEN = "UPDATE users SET refresh_token = NULL WHERE user_id = ? AND refresh_token = ?"
+SELECT_SYNC_CURSOR = "SELECT last_start_date, last_activity_id FROM sync_state WHERE user_id = ?"
+UPSERT_SYNC_CURSOR = (
+    "INSERT INTO sync_state (user_id, last_start_date, last_activity_id, synced_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET last_start_date = excluded.last_start_date, "
+    "last_activity_id = excluded.last_activity_id, synced_at = excluded.synced_at"
+)
+SELECT_KNOWN_ACTIVITIES = (
+    "SELECT activity_id, name, total_photo_count FROM activities WHERE user_id = ? AND start_date >= ?"
+)
+UPSERT_ACTIVITY = (
+    "INSERT OR REPLACE INTO activities (user_id, activity_id, start_date, name, total_photo_count) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+DELETE_ACTIVITY = "DELETE FROM activities WHERE user_id = ? AND activity_id = ?"
+SELECT_PHOTO_FILE_ID = "SELECT unique_id, file_id FROM photo_file_ids WHERE unique_id = ?"
+UPSERT_PHOTO_FILE_ID = "INSERT OR REPLACE INTO photo_file_ids (unique_id, file_id) VALUES (?, ?)"
+SELECT_CACHED_RESPONSE = "SELECT body, expires_at, accessed_at FROM http_cache WHERE key = ?"
+UPSERT_CACHED_RESPONSE = (
+    "INSERT OR REPLACE INTO http_cache (key, scope, path, body, size, expires_at, accessed_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+TOUCH_CACHED_RESPONSE = "UPDATE http_cache SET accessed_at = ? WHERE key = ?"
+DELETE_CACHED_RESPONSES = (
+    "DELETE FROM http_cache WHERE (:scope IS NULL OR scope = :scope) "
+    "AND (:path IS NULL OR path = :path OR path LIKE :path || '/%')"
+)
+DELETE_EXPIRED_RESPONSES = "DELETE FROM http_cache WHERE expires_at <= ?"
+# Удаляем давно не читавшиеся записи, пока суммарный размер не уложится в лимит
+DELETE_LRU_RESPONSES = (
+    "DELETE FROM http_cache WHERE key IN (SELECT key FROM "
+    "(SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM http_cache) WHERE total > ?)"
+)
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def _migrate(conn):
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    for table, columns in MIGRATIONS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+    conn.executescript(INDEXES)
+    conn.commit()
+
+
+# Асинхронный доступ к users.db — единственное место, где хранятся токены, курсоры и кэши.
+# Чтение идёт через небольшой пул соединений (WAL позволяет читать параллельно с записью),
+# запись — через одно соединение в отдельном потоке: операции, накопившиеся в очереди,
+# выполняются одной транзакцией с одним commit.
+class Database:
+    def __init__(self, path=DATABASE_PATH, readers=DB_READERS, write_batch=DB_WRITE_BATCH):
+        self.path = path
+        self.readers = readers
+        self.write_batch = write_batch
+        self._readers = None
+        self._writer = None
+        self._writer_executor = None
+        self._writes = None
+        self._writer_task = None
+        self._opening = None
+
+    async def open(self):
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        await self._opening
+
+    async def _open(self):
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        loop = asyncio.get_running_loop()
+        self._writer = await loop.run_in_executor(self._writer_executor, _connect, self.path)
+        await loop.run_in_executor(self._writer_executor, _migrate, self._writer)
+
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers):
+            self._readers.put_nowait(await asyncio.to_thread(_connect, self.path))
+
+        self._writes = asyncio.Queue()
+        self._writer_task = asyncio.ensure_future(self._writer_loop())
+        logger.info(f"База данных {self.path} открыта")
+
+    async def close(self):
+        if self._opening is None:
+            return
+        await self._opening
+        # Дописываем то, что уже стоит в очереди
+        await self._writes.join()
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        await asyncio.get_running_loop().run_in_executor(self._writer_executor, self._writer.close)
+        self._writer_executor.shutdown(wait=False)
+        self._opening = None
+        logger.info(f"База данных {self.path} закрыта")
+
+    # Чтение: fn(conn, *args) выполняется в потоке на свободном соединении из пула.
+    # Отмена вызывающего не останавливает поток, поэтому соединение возвращается в пул
+    # только по завершении потока, а не при выходе из _read.
+    async def _read(self, fn, *args):
+        await self.open()
+        conn = await self._readers.get()
+        future = asyncio.ensure_future(asyncio.to_thread(fn, conn, *args))
+        future.add_done_callback(lambda done: self._release(conn, done))
+        return await asyncio.shield(future)
+
+    def _release(self, conn, future):
+        self._readers.put_nowait(conn)
+        # Если вызывающего отменили, ошибку чтения никто не заберёт — забираем здесь
+        if not future.cancelled():
+            future.exception()
+
+    async def _fetchone(self, sql, params):
+        return await self._read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def _fetchall(self, sql, params):
+        return await self._read(lambda conn: conn.execute(sql, params).fetchall())
+
+    # Запись: ставится в очередь писателя, результат — число затронутых строк
+    async def _write(self, sql, params, many=False):
+        await self.open()
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait((sql, params, many, future))
+        return await future
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._writes.get()]
+            while len(batch) < self.write_batch and not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._writer_executor, self._apply_batch, batch)
+            except Exception as e:
+                # Писатель не должен умирать: иначе все последующие записи повиснут
+                logger.exception("Ошибка записи в базу")
+                results = [e] * len(batch)
+            try:
+                for (*_, future), result in zip(batch, results):
+                    if not future.done():
+                        if isinstance(result, Exception):
+                            future.set_exception(result)
+                        else:
+                            future.set_result(result)
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    # Ловим любые ошибки, а не только sqlite3.Error: например, слишком большое целое
+    # в параметрах даёт OverflowError ещё до выполнения запроса
+    def _apply_batch(self, batch):
+        conn = self._writer
+        try:
+            with conn:
+                return [self._execute(conn, sql, params, many) for sql, params, many, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                return [e]
+        # Одна операция сломала пачку: повторяем по одной, чтобы ошибка досталась только ей
+        results = []
+        for sql, params, many, _ in batch:
+            try:
+                with conn:
+                    results.append(self._execute(conn, sql, params, many))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def _execute(conn, sql, params, many):
+        cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+        return cursor.rowcount
+
+    # Токены пользователя: (user_id, access_token, refresh_token, expires_at) или None
+    async def get_user(self, user_id):
+        return await self._fetchone(SELECT_USER, (user_id,))
+
+    # athlete_id=None оставляет уже сохранённый id атлета
+    async def save_user_tokens(self, user_id, access_token, refresh_token, expires_at, athlete_id=None):
+        await self._write(UPSERT_USER, (user_id, access_token, refresh_token, expires_at, athlete_id))
+
+    # Telegram user_id по id атлета Strava
+    async def get_user_id_by_athlete(self, athlete_id):
+        row = await self._fetchone(SELECT_USER_BY_ATHLETE, (athlete_id,))
+        return row[0] if row else None
+
+    async def delete_user(self, user_id):
+        await asyncio.gather(*(self._write(sql, (user_id,)) for sql in DELETE_USER_DATA))
+
+    # Пользователи, чей access_token истекает раньше until и чей токен сейчас никто
+    # не обновляет: [(user_id, expires_at), ...]
+    async def get_users_expiring_before(self, until, now):
+        return await self._fetchall(SELECT_EXPIRING_USERS, (until, now))
+
+    # True, если обновление токена захвачено этим вызовом до момента until
+    async def claim_token_refresh(self, user_id, refresh_token, now, until):
+        return await self._write(CLAIM_TOKEN_REFRESH, (until, user_id, refresh_token, now)) == 1
+
+    async def clear_refresh_token(self, user_id, refresh_token):
+        await self._write(CLEAR_REFRESH_TOKEN, (user_id, refresh_token))
+
+    # Курсор синхронизации пользователя: (start_date, activity_id) самой новой активности
+    async def get_sync_cursor(self, user_id):
+        return await self._fetchone(SELECT_SYNC_CURSOR, (user_id,))
+
+    async def set_sync_cursor(self, user_id, start_date, activity_id, synced_at):
+        await self._write(UPSERT_SYNC_CURSOR, (user_id, start_date, activity_id, synced_at))
+
+    # Известные активности пользователя начиная с даты since: {activity_id: (name, total_photo_count)}
+    async def get_known_activities(self, user_id, since):
+        rows = await self._fetchall(SELECT_KNOWN_ACTIVITIES, (user_id, since))
+        return {activity_id: (name, total_photo_count) for activity_id, name, total_photo_count in rows}
+
+    # rows: [(activity_id, start_date, name, total_photo_count), ...]
+    async def save_activities(self, user_id, rows):
+        await self._write(UPSERT_ACTIVITY, [(user_id, *row) for row in rows], many=True)
+
+    async def delete_activities(self, user_id, activity_ids):
+        await self._write(DELETE_ACTIVITY, [(user_id, activity_id) for activity_id in activity_ids], many=True)
+
+    # file_id Telegram для уже отправленных фотографий Strava: {unique_id: file_id}
+    async def get_photo_file_ids(self, unique_ids):
+        def fetch(conn):
+            result = {}
+            for unique_id in unique_ids:
+                row = conn.execute(SELECT_PHOTO_FILE_ID, (unique_id,)).fetchone()
+                if row:
+                    result[row[0]] = row[1]
+            return result
+        return await self._read(fetch)
+
+    # rows: [(unique_id, file_id), ...]
+    async def save_photo_file_ids(self, rows):
+        await self._write(UPSERT_PHOTO_FILE_ID, rows, many=True)
+
+    # Кэш ответов Strava: (body, expires_at, accessed_at) или None
+    async def get_cached_response(self, key):
+        return await self._fetchone(SELECT_CACHED_RESPONSE, (key,))
+
+    async def save_cached_response(self, key, scope, path, body, expires_at, accessed_at):
+        await self._write(UPSERT_CACHED_RESPONSE, (key, scope, path, body, len(body), expires_at, accessed_at))
+
+    async def touch_cached_response(self, key, accessed_at):
+        await self._write(TOUCH_CACHED_RESPONSE, (accessed_at, key))
+
+    # Удаление записей кэша по пользователю и/или пути (вместе с вложенными путями)
+    async def delete_cached_responses(self, scope=None, path=None):
+        return await self._write(DELETE_CACHED_RESPONSES, {"scope": scope, "path": path})
+
+    async def evict_cached_responses(self, now, max_bytes):
+        expired = await self._write(DELETE_EXPIRED_RESPONSES, (now,))
+        evicted = await self._write(DELETE_LRU_RESPONSES, (max_bytes,))
+        return expired + evicted
+
+
+# Общий экземпляр базы для всего приложения
+database = Database()
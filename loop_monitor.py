@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Как часто event loop отмечается и измеряется его задержка (секунды)
+LOOP_MONITOR_INTERVAL = float(os.environ.get('LOOP_MONITOR_INTERVAL', 0.25))
+# Если loop не отмечался дольше этого, считаем его заблокированным и логируем стек
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', 0.5))
+# Глубина стека в логе о блокировке
+LOOP_BLOCK_STACK_LIMIT = int(os.environ.get('LOOP_BLOCK_STACK_LIMIT', 15))
+
+loop_lag_seconds = registry.histogram(
+    "event_loop_lag_seconds",
+    "Насколько позже запланированного просыпается event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+loop_blocked_total = registry.counter(
+    "event_loop_blocked_total",
+    "Случаи, когда один обратный вызов держал event loop дольше порога",
+)
+loop_blocked_seconds = registry.counter(
+    "event_loop_blocked_seconds_total",
+    "Суммарное время блокировок event loop",
+)
+
+
+# Монитор event loop.
+# Задача в loop каждые interval секунд измеряет задержку пробуждения и отмечается;
+# сторожевой поток замечает, что отметок нет дольше threshold, и логирует стек
+# потока loop и текущую задачу — то, что держит loop прямо сейчас.
+class LoopMonitor:
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD,
+                 stack_limit=LOOP_BLOCK_STACK_LIMIT):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_limit = stack_limit
+        self._heartbeat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    async def _tick(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._heartbeat = now
+            loop_lag_seconds.observe(lag)
+
+    # Что выполняется в loop в данный момент: имя текущей задачи и стек потока loop
+    def _describe_blocker(self):
+        task = asyncio.current_task(self._loop)
+        coroutine = task.get_coro().__qualname__ if task is not None else "обратный вызов вне задачи"
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=self.stack_limit)) if frame else ""
+        return coroutine, stack
+
+    def _watch(self):
+        blocked_since = None
+        while not self._stopped.wait(self.threshold / 2):
+            stalled = time.monotonic() - self._heartbeat
+            if stalled > self.threshold + self.interval:
+                if blocked_since is None:
+                    blocked_since = self._heartbeat
+                    coroutine, stack = self._describe_blocker()
+                    loop_blocked_total.inc()
+                    logger.warning(
+                        f"Event loop заблокирован дольше {stalled:.2f} с, выполняется {coroutine}:\n{stack}"
+                    )
+            elif blocked_since is not None:
+                # Между отметками в норме проходит interval, его не считаем блокировкой
+                duration = max(0.0, self._heartbeat - blocked_since - self.interval)
+                loop_blocked_seconds.inc(amount=duration)
+                logger.warning(f"Event loop разблокирован после {duration:.2f} с")
+                blocked_since = None
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._watchdog.join()
+        self._watchdog = None
+
+
+# Общий монитор приложения
+loop_monitor = LoopMonitor()
@@ -1,14 +1,40 @@
 import os
+import hmac
+import math
 import logging
-import uuid
-from quart import Quart, request, jsonify
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import time
+import weakref
+from collections import deque
+from quart import Quart, Response, request, jsonify, g
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes
 import asyncio
-import requests
+import httpx
+from strava_client import strava
+from rate_limiter import PRIORITY_BACKGROUND
+from activity_sync import ActivitySync
+from telegram_sender import TelegramSender, is_not_delivered
+from oauth_state import sign_state, verify_state
+from token_refresher import token_refresher
+from resilience import CircuitOpenError, CLOSED, upstreams
+from strava_events import StravaEventQueue, validate_subscription
+from db import database
+from metrics import registry, http_request_seconds, telegram_update_seconds, CONTENT_TYPE
+import tracing
+from tracing import TraceIdFilter, start_trace, continue_trace, current_span, span
+from loop_monitor import loop_monitor
+from profiler import profiler, ProfilerBusyError
+from safe_logging import RedactingFilter, RepeatFilter, Lazy, mask, summarize, truncate
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:[%(trace_id)s] %(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RepeatFilter())
+    handler.addFilter(RedactingFilter())
+    handler.addFilter(TraceIdFilter())
+# httpx пишет каждый запрос на INFO, а URL Bot API содержит токен бота
+logging.getLogger("httpx").setLevel(os.getenv("HTTPX_LOG_LEVEL", "WARNING"))
 logger = logging.getLogger(__name__)
 
 # Чтение переменных окружения
@@ -17,6 +43,19 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
 STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
 PORT = int(os.getenv("PORT", 5000))
+PHOTO_FETCH_CONCURRENCY = int(os.getenv("PHOTO_FETCH_CONCURRENCY", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+# Синхронизации после авторизации выполняются фоновыми воркерами
+SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", 1000))
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 16))
+# Токен для служебных эндпоинтов (/admin/...); если не задан, они отключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Адрес Bot API; переопределяется для локального сервера или фейкового для нагрузочных тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+MEDIA_GROUP_SIZE = 10  # Максимум фотографий в одном альбоме Telegram
+
+PLACEHOLDER_PHOTO = "placeholder-photo@4x-6c5d2aaeadca1292be72943c04ea6defe7dcd610da7dc87a1ccaad30e134b2d6.png"
 
 # Проверка переменных окружения
 if not TELEGRAM_TOKEN:
@@ -33,50 +72,105 @@ if not STRAVA_CLIENT_ID or not STRAVA_CLIENT_SECRET:
 app = Quart(__name__)
 
 # Инициализация Telegram Bot API
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+application = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .base_url(f"{TELEGRAM_API_URL}/bot")
+    .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    .build()
+)
+
+# Очередь исходящих сообщений с учётом лимитов Telegram
+sender = TelegramSender(application.bot)
+
+# Метрики очередей, квот и кэшей; значения снимаются только при запросе /metrics
+photo_cache_requests = registry.counter(
+    "telegram_photo_cache_requests_total", "Поиск file_id фотографий в кэше", ("result",),
+)
 
-# Временное хранилище для state (в реальном проекте лучше использовать базу данных)
-state_storage = {}
+def strava_quota(field):
+    snapshot = strava.limiter.snapshot()
+    if field == "remaining":
+        return {
+            ("short",): snapshot["short_limit"] - snapshot["short_usage"],
+            ("long",): snapshot["long_limit"] - snapshot["long_usage"],
+        }
+    return {("short",): snapshot[f"short_{field}"], ("long",): snapshot[f"long_{field}"]}
+
+registry.gauge("strava_rate_limit", "Квота Strava по окнам", lambda: strava_quota("limit"), ("window",))
+registry.gauge("strava_rate_limit_usage", "Израсходовано квоты Strava", lambda: strava_quota("usage"), ("window",))
+registry.gauge(
+    "strava_rate_limit_remaining", "Остаток квоты Strava", lambda: strava_quota("remaining"), ("window",),
+)
+registry.gauge(
+    "strava_request_queue_depth", "Запросы к Strava, ожидающие квоты",
+    lambda: {(str(priority),): count for priority, count in strava.limiter.snapshot()["queued_by_priority"].items()},
+    ("priority",),
+)
+registry.gauge("webhook_queue_depth", "Обновления Telegram в очереди", lambda: update_queue.qsize() if update_queue else 0)
+registry.gauge("sync_queue_depth", "Синхронизации в очереди", lambda: sync_queue.qsize() if sync_queue else 0)
+registry.gauge("strava_event_queue_depth", "События Strava в очереди", lambda: strava_events.snapshot()["queued"])
+registry.gauge("telegram_send_queue_depth", "Сообщения в очередях отправки", lambda: sender.snapshot()["queued"])
+registry.gauge(
+    "strava_response_cache_requests_total", "Обращения к кэшу ответов Strava",
+    lambda: {("hit",): strava.cache.hits, ("miss",): strava.cache.misses}, ("result",), kind="counter",
+)
+registry.gauge(
+    "upstream_circuit_open", "Автомат защиты разомкнут (1) или нет (0)",
+    lambda: {(name,): int(upstream.breaker.state != CLOSED) for name, upstream in upstreams.items()},
+    ("upstream",),
+)
+registry.gauge(
+    "upstream_retries_total", "Повторы вызовов внешних сервисов",
+    lambda: {(name,): upstream.retries for name, upstream in upstreams.items()}, ("upstream",), kind="counter",
+)
+registry.gauge(
+    "upstream_rejected_total", "Вызовы, отклонённые автоматом защиты",
+    lambda: {(name,): upstream.rejected for name, upstream in upstreams.items()}, ("upstream",), kind="counter",
+)
 
 # Получение данных пользователя Strava
-def get_strava_athlete_data(access_token):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://www.strava.com/api/v3/athlete", headers=headers)
+async def get_strava_athlete_data(access_token, user_id=None):
+    try:
+        response = await strava.get("/athlete", access_token, cache_scope=user_id)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error("Ошибка соединения со Strava: %r", e)
+        return None
     if response.status_code == 200:
         return response.json()  # Возвращаем данные пользователя
     else:
-        logger.error(f"Ошибка получения данных Strava: {response.text}")
+        logger.error("Ошибка получения данных Strava: %s %s", response.status_code, truncate(response.text))
         return None
 
-# Получение активностей пользователя Strava
-def get_strava_activities(access_token):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://www.strava.com/api/v3/athlete/activities", headers=headers)
-    if response.status_code == 200:
-        activities = response.json()
-        logger.info(f"Полученные активности: {activities}")
-        return activities  # Возвращаем список активностей
-    else:
-        logger.error(f"Ошибка получения активностей Strava: {response.text}")
-        return []
-
-# Получение фотографий активности
-def get_activity_photos(access_token, activity_id):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(f"https://www.strava.com/api/v3/activities/{activity_id}/photos", headers=headers)
+# Получение фотографий активности (None, если получить не удалось)
+async def get_activity_photos(access_token, activity_id, user_id=None):
+    try:
+        response = await strava.get(
+            f"/activities/{activity_id}/photos", access_token,
+            priority=PRIORITY_BACKGROUND, cache_scope=user_id,
+        )
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(
+            "Ошибка соединения со Strava для активности %s: %r", activity_id, e,
+            extra={"user_id": user_id, "activity_id": activity_id},
+        )
+        return None
     if response.status_code == 200:
         photos = response.json()
-        logger.info(f"Полученные фотографии для активности {activity_id}: {photos}")
+        logger.debug("Фотографии активности %s: %s", activity_id, Lazy(summarize, photos, "unique_id"))
         return photos
     else:
-        logger.error(f"Ошибка получения фотографий Strava для активности {activity_id}: {response.text}")
-        return []
+        logger.error(
+            "Ошибка получения фотографий Strava для активности %s: %s %s",
+            activity_id, response.status_code, truncate(response.text),
+            extra={"user_id": user_id, "activity_id": activity_id},
+        )
+        return None
 
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    state = str(uuid.uuid4())  # Генерируем уникальный state
-    state_storage[user_id] = state  # Сохраняем state для пользователя
+    state = sign_state(user_id)  # Подписанный state с user_id, без хранения на сервере
 
     auth_url = (
         f"https://www.strava.com/oauth/authorize"
@@ -89,114 +183,549 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     keyboard = [[InlineKeyboardButton("Авторизоваться в Strava", url=auth_url)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Нажмите кнопку ниже, чтобы авторизоваться в Strava:", reply_markup=reply_markup)
+    await sender.send_message(
+        chat_id=update.effective_chat.id,
+        text="Нажмите кнопку ниже, чтобы авторизоваться в Strava:",
+        reply_markup=reply_markup,
+    )
+
+# Служебное сообщение пользователю: ошибка отправки только логируется
+async def notify(chat_id, text):
+    try:
+        await sender.send_message(chat_id=chat_id, text=text)
+    except (TelegramError, CircuitOpenError) as e:
+        logger.error("Не удалось отправить сообщение в чат %s: %r", chat_id, e, extra={"user_id": chat_id})
 
 # Регистрация обработчика команды /start
 application.add_handler(CommandHandler("start", start))
 
-# Асинхронный маршрут для обработки вебхуков Telegram
+# Очередь входящих обновлений Telegram (создаётся при старте, в рабочем event loop)
+update_queue = None
+update_workers = []
+
+# Воркер, разбирающий очередь обновлений Telegram
+async def update_worker():
+    while True:
+        update, parent = await update_queue.get()
+        started = time.perf_counter()
+        try:
+            with continue_trace(parent, "telegram_update", update_id=update.update_id):
+                await application.process_update(update)
+        except Exception:
+            logger.exception("Ошибка обработки обновления %s", update.update_id)
+        finally:
+            telegram_update_seconds.observe(time.perf_counter() - started)
+            update_queue.task_done()
+
+# Очередь синхронизаций: ни /strava_callback, ни воркеры событий Strava не ждут выгрузки
+# активностей и отправки фотографий (с лимитом 1 сообщение в секунду на чат это минуты)
+sync_queue = None
+sync_workers = []
+# Пользователи, чья синхронизация стоит в очереди и ещё не началась
+queued_syncs = set()
+
+# Постановка синхронизации в очередь; False, если очередь переполнена.
+# Если синхронизация пользователя уже ждёт в очереди, фоновая (quiet) не добавляется:
+# ждущая заберёт и новые активности.
+def schedule_sync(user_id, access_token, quiet=False):
+    if quiet and user_id in queued_syncs:
+        return True
+    try:
+        sync_queue.put_nowait((user_id, access_token, quiet, current_span()))
+    except asyncio.QueueFull:
+        logger.warning(
+            "Очередь синхронизаций переполнена, синхронизация пользователя %s отклонена", user_id,
+            extra={"user_id": user_id},
+        )
+        return False
+    queued_syncs.add(user_id)
+    return True
+
+async def sync_worker():
+    while True:
+        user_id, access_token, quiet, parent = await sync_queue.get()
+        queued_syncs.discard(user_id)
+        try:
+            with continue_trace(parent, "sync_worker", user_id=user_id):
+                await process_activities(user_id, access_token, quiet=quiet)
+        except Exception:
+            logger.exception("Ошибка синхронизации активностей пользователя %s", user_id, extra={"user_id": user_id})
+        finally:
+            sync_queue.task_done()
+
+# Запуск и остановка общих ресурсов вместе с приложением.
+# Application инициализируется один раз здесь, а не на каждом вебхуке.
+@app.before_serving
+async def startup():
+    global update_queue, sync_queue
+    loop_monitor.start()
+    await database.open()
+    await strava.start()
+    await application.initialize()
+    await application.start()
+    token_refresher.start()
+    strava_events.start()
+    update_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    update_workers[:] = [asyncio.ensure_future(update_worker()) for _ in range(WEBHOOK_WORKERS)]
+    sync_queue = asyncio.Queue(maxsize=SYNC_QUEUE_SIZE)
+    sync_workers[:] = [asyncio.ensure_future(sync_worker()) for _ in range(SYNC_WORKERS)]
+
+@app.after_serving
+async def shutdown():
+    for worker in update_workers + sync_workers:
+        worker.cancel()
+    await asyncio.gather(*update_workers, *sync_workers, return_exceptions=True)
+    update_workers.clear()
+    sync_workers.clear()
+    await strava_events.close()
+    await token_refresher.close()
+    await sender.close()
+    await application.stop()
+    await application.shutdown()
+    await strava.close()
+    await database.close()
+    tracing.flush()
+    await loop_monitor.close()
+
+# Каждый входящий запрос — корневой спан трассировки и наблюдение для /metrics
+@app.before_request
+async def start_request():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = start_trace(f"{request.method} {route}").begin()
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def finish_request(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_seconds.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+        g.trace.set("status", response.status_code)
+        g.trace.end()
+    return response
+
+# Метрики в формате Prometheus
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+def is_admin_request():
+    supplied = request.headers.get("Authorization", "").replace("Bearer ", "", 1)
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+# Профилирование живого процесса: ?mode=cpu|memory&seconds=N&top=M[&threads=all].
+# Сэмплирующий профиль CPU (по умолчанию потока event loop) или разница снимков tracemalloc;
+# одновременно — только один замер.
+@app.get("/admin/profile")
+async def admin_profile():
+    if not ADMIN_TOKEN:
+        return jsonify({"status": "disabled"}), 404
+    if not is_admin_request():
+        return jsonify({"status": "forbidden"}), 403
+    mode = request.args.get("mode", "cpu")
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        top = int(request.args.get("top", 30))
+        interval = float(request.args["interval"]) if "interval" in request.args else None
+    except ValueError:
+        return jsonify({"status": "error", "description": "seconds, top и interval должны быть числами"}), 400
+    # nan и inf проходят сравнения и ломают таймеры event loop
+    if (mode not in ("cpu", "memory") or not math.isfinite(seconds) or seconds <= 0 or top <= 0
+            or (interval is not None and (not math.isfinite(interval) or interval <= 0))):
+        return jsonify({
+            "status": "error", "description": "mode=cpu|memory, конечные seconds > 0 и interval > 0, top > 0",
+        }), 400
+    try:
+        if mode == "cpu":
+            result = await profiler.cpu(
+                seconds, top=top, interval=interval, all_threads=request.args.get("threads") == "all",
+            )
+        else:
+            result = await profiler.memory(seconds, top=top)
+    except ProfilerBusyError:
+        return jsonify({"status": "busy"}), 409
+    return jsonify(result)
+
+# Текущая квота Strava и глубина очереди запросов
+@app.get("/strava_limits")
+async def strava_limits():
+    return jsonify(strava.limiter.snapshot())
+
+# Состояние автоматов защиты и счётчики повторов по внешним сервисам
+@app.get("/upstreams")
+async def upstreams_status():
+    return jsonify({name: upstream.snapshot() for name, upstream in upstreams.items()})
+
+# Асинхронный маршрут для обработки вебхуков Telegram.
+# Обновление только проверяется и ставится в очередь, ответ уходит сразу;
+# при переполненной очереди отвечаем 503, и Telegram повторит доставку позже.
 @app.post("/webhook")
 async def telegram_webhook():
-    data = await request.get_json()
-    if data:
+    data = await request.get_json(silent=True)
+    if not data:
+        return jsonify({"status": "ok"})
+    try:
         update = Update.de_json(data, application.bot)
-        await application.initialize()
-        await application.process_update(update)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning("Некорректное обновление Telegram: %r", e)
+        return jsonify({"status": "error"}), 400
+    if update is None:
+        return jsonify({"status": "error"}), 400
+
+    try:
+        update_queue.put_nowait((update, current_span()))
+    except asyncio.QueueFull:
+        logger.warning("Очередь обновлений переполнена, обновление %s отклонено", update.update_id)
+        return jsonify({"status": "busy"}), 503
     return jsonify({"status": "ok"})
 
-# Обработка активностей пользователя с отправкой фотографий
-async def process_activities(user_id, access_token):
-    activities = get_strava_activities(access_token)
-    if not activities:
-        await application.bot.send_message(chat_id=user_id, text="Активности не найдены.")
-        return
+# Выбор URL фотографии наибольшего доступного размера (None для заглушек)
+def select_photo_url(photo):
+    # Попытка получить доступные размеры
+    if "urls" not in photo:
+        return None
+    if "1800" in photo["urls"]:
+        photo_url = photo["urls"]["1800"]
+    elif "600" in photo["urls"]:
+        photo_url = photo["urls"]["600"]
+    else:
+        photo_url = next(iter(photo["urls"].values()), None)
+
+    if photo_url and not photo_url.endswith(PLACEHOLDER_PHOTO):
+        return photo_url
+    return None
+
+# Отправка фотографий одной активности альбомами по MEDIA_GROUP_SIZE штук.
+# photos — список пар (unique_id, url). Для уже отправлявшихся фотографий берём
+# file_id из кэша, и Telegram не скачивает их заново.
+# Подпись ставится на первую фотографию; если альбом точно не доставлен, шлём фото по одному.
+# После ошибок с неизвестным исходом (таймаут, обрыв соединения) повторно не отправляем:
+# сообщение могло дойти, и повтор дал бы дубли.
+# Возвращает True, если все фотографии доставлены или могли быть доставлены.
+async def send_activity_photos(chat_id, photos, caption=None):
+    unique_ids = [unique_id for unique_id, _ in photos if unique_id]
+    cached = await database.get_photo_file_ids(unique_ids) if unique_ids else {}
+    photo_cache_requests.inc("hit", amount=len(cached))
+    photo_cache_requests.inc("miss", amount=len(unique_ids) - len(cached))
+    new_file_ids = {}
+    delivered = True
+
+    def remember(unique_id, message):
+        if unique_id and message and message.photo:
+            file_id = message.photo[-1].file_id
+            if cached.get(unique_id) != file_id:
+                new_file_ids[unique_id] = file_id
 
+    # Одиночная отправка: сначала по file_id из кэша, при ошибке — по URL
+    async def send_single(unique_id, url, photo_caption):
+        nonlocal delivered
+        file_id = cached.get(unique_id)
+        if file_id:
+            try:
+                return await sender.send_photo(chat_id=chat_id, photo=file_id, caption=photo_caption)
+            except (TelegramError, CircuitOpenError) as e:
+                if not is_not_delivered(e):
+                    logger.error("Фотография %s в чат %s могла не дойти: %r", unique_id, chat_id, e, extra={"user_id": chat_id})
+                    return None
+                logger.warning("Не удалось отправить фотографию %s по file_id: %r", unique_id, e, extra={"user_id": chat_id})
+        try:
+            message = await sender.send_photo(chat_id=chat_id, photo=url, caption=photo_caption)
+        except (TelegramError, CircuitOpenError) as e:
+            logger.error("Ошибка отправки фотографии %s в чат %s: %r", url, chat_id, e, extra={"user_id": chat_id})
+            if is_not_delivered(e):
+                delivered = False
+            return None
+        remember(unique_id, message)
+        return message
+
+    for offset in range(0, len(photos), MEDIA_GROUP_SIZE):
+        chunk = photos[offset:offset + MEDIA_GROUP_SIZE]
+        chunk_caption = caption if offset == 0 else None
+        if len(chunk) == 1:
+            await send_single(*chunk[0], chunk_caption)
+            continue
+
+        media = [
+            InputMediaPhoto(media=cached.get(unique_id, url), caption=chunk_caption if index == 0 else None)
+            for index, (unique_id, url) in enumerate(chunk)
+        ]
+        try:
+            messages = await sender.send_media_group(chat_id=chat_id, media=media)
+        except (TelegramError, CircuitOpenError) as e:
+            if not is_not_delivered(e):
+                logger.error(
+                    "Альбом в чат %s мог не дойти, повторно не отправляем: %r", chat_id, e,
+                    extra={"user_id": chat_id, "photos": len(chunk)},
+                )
+                continue
+            logger.warning(
+                "Не удалось отправить альбом в чат %s, отправляем по одной: %r", chat_id, e,
+                extra={"user_id": chat_id, "photos": len(chunk)},
+            )
+            for index, (unique_id, url) in enumerate(chunk):
+                await send_single(unique_id, url, chunk_caption if index == 0 else None)
+        else:
+            for (unique_id, _), message in zip(chunk, messages):
+                remember(unique_id, message)
+
+    if new_file_ids:
+        await database.save_photo_file_ids(list(new_file_ids.items()))
+    return delivered
+
+# Блокировки синхронизации по пользователям: /strava_callback и события Strava
+# не должны одновременно синхронизировать одного пользователя и слать дубли фото
+sync_locks = weakref.WeakValueDictionary()
+
+# Обработка активностей пользователя с отправкой фотографий.
+# quiet=True — фоновый запуск: без сообщений «активности не найдены».
+async def process_activities(user_id, access_token, quiet=False):
+    lock = sync_locks.get(user_id)
+    if lock is None:
+        lock = sync_locks[user_id] = asyncio.Lock()
+    with span("process_activities", user_id=user_id, quiet=quiet):
+        async with lock:
+            await _process_activities(user_id, access_token, quiet)
+
+# Метаданные фотографий запрашиваются параллельно (не больше PHOTO_FETCH_CONCURRENCY
+# одновременно), а отправка идёт строго в порядке активностей.
+# Активность подтверждается синхронизации только после доставки её фотографий:
+# недоставленные останутся новыми и будут отправлены при следующем запуске.
+async def _process_activities(user_id, access_token, quiet):
+    started = time.monotonic()
+    timings = {"fetch": 0.0, "send": 0.0}
+    semaphore = asyncio.Semaphore(PHOTO_FETCH_CONCURRENCY)
+    pending = deque()
     photos_found = False
-    for activity in activities:
-        activity_id = activity.get("id")
-        total_photo_count = activity.get("total_photo_count", 0)
-
-        if total_photo_count > 0:
-            photos = get_activity_photos(access_token, activity_id)
-            for photo in photos:
-                # Попытка получить доступные размеры
-                if "urls" in photo:
-                    if "1800" in photo["urls"]:
-                        photo_url = photo["urls"]["1800"]
-                    elif "600" in photo["urls"]:
-                        photo_url = photo["urls"]["600"]
-                    else:
-                        photo_url = next(iter(photo["urls"].values()), None)
-                    
-                    if photo_url and not photo_url.endswith("placeholder-photo@4x-6c5d2aaeadca1292be72943c04ea6defe7dcd610da7dc87a1ccaad30e134b2d6.png"):
-                        photos_found = True
-                        await application.bot.send_photo(chat_id=user_id, photo=photo_url)
-
-    if not photos_found:
-        await application.bot.send_message(chat_id=user_id, text="Фотографии в ваших активностях не найдены.")
+
+    async def fetch_photos(activity):
+        async with semaphore:
+            fetch_started = time.monotonic()
+            if sync.known_photo_count(activity):
+                # У известной активности прибавились фото: кэшированный список устарел
+                await strava.cache.invalidate(scope=user_id, path=f"/activities/{activity.get('id')}/photos")
+            with span("get_activity_photos", activity_id=activity.get("id")):
+                photos = await get_activity_photos(access_token, activity.get("id"), user_id)
+            timings["fetch"] += time.monotonic() - fetch_started
+            return activity, photos
+
+    async def send_photos(activity, photos):
+        nonlocal photos_found
+        if photos is None:
+            return
+        photo_items = []
+        for photo in photos:
+            photo_url = select_photo_url(photo)
+            if photo_url:
+                photo_items.append((photo.get("unique_id"), photo_url))
+        if sync.known_photo_count(activity):
+            # Отправляем только добавленные: у отправленных раньше есть file_id в кэше
+            unique_ids = [unique_id for unique_id, _ in photo_items if unique_id]
+            sent = await database.get_photo_file_ids(unique_ids) if unique_ids else {}
+            photo_items = [item for item in photo_items if item[0] not in sent]
+        if not photo_items:
+            sync.confirm(activity)
+            return
+        photos_found = True
+        send_started = time.monotonic()
+        with span("send_activity_photos", activity_id=activity.get("id"), photos=len(photo_items)):
+            delivered = await send_activity_photos(user_id, photo_items, caption=activity.get("name"))
+        timings["send"] += time.monotonic() - send_started
+        if delivered:
+            sync.confirm(activity)
+
+    sync = ActivitySync(user_id, access_token)
+    try:
+        async for activity in sync.run():
+            if activity.get("total_photo_count", 0) > 0:
+                pending.append(asyncio.ensure_future(fetch_photos(activity)))
+                # Не убегаем слишком далеко вперёд отправки
+                if len(pending) > PHOTO_FETCH_CONCURRENCY * 2:
+                    await send_photos(*await pending.popleft())
+            else:
+                sync.confirm(activity)
+        while pending:
+            await send_photos(*await pending.popleft())
+    finally:
+        for task in pending:
+            task.cancel()
+    await sync.commit()
+
+    if not quiet:
+        if not sync.complete and not sync.new:
+            await notify(user_id, "Не удалось получить активности из Strava. Попробуйте позже.")
+        elif not sync.new and not photos_found:
+            await notify(user_id, "Новых активностей нет." if sync.incremental else "Активности не найдены.")
+        elif not photos_found:
+            await notify(user_id, "Фотографии в ваших активностях не найдены.")
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Обработка активностей пользователя %s: всего %.2f с, запросы фото %.2f с (суммарно), отправка %.2f с",
+        user_id, elapsed, timings["fetch"], timings["send"],
+        extra={
+            "user_id": user_id, "activities_new": sync.new, "elapsed_s": elapsed,
+            "fetch_s": timings["fetch"], "send_s": timings["send"],
+        },
+    )
 
 # Асинхронный маршрут для обработки обратного вызова от Strava
 @app.route("/strava_callback", methods=["GET"])
 async def strava_callback():
     code = request.args.get("code")
     returned_state = request.args.get("state")
-    user_id = None
 
-    # Логирование полученных параметров
-    logger.info(f"Получен код: {code}")
-    logger.info(f"Получен state: {returned_state}")
+    # Логирование полученных параметров (code одноразовый, но это секрет — только хвост)
+    logger.info(f"Обратный вызов Strava: code {mask(code)}")
 
-    # Проверяем соответствие state
-    for uid, saved_state in state_storage.items():
-        if saved_state == returned_state:
-            user_id = uid
-            break
+    # Проверяем подпись и срок действия state
+    user_id = verify_state(returned_state)
+    g.trace.set("user_id", user_id)
 
     if not user_id:
         logger.warning("State не совпадает или пользователь не найден.")
         return "Ошибка: state не совпадает или пользователь не найден.", 400
 
     # Обмениваем code на access token
-    response = requests.post(
-        "https://www.strava.com/oauth/token",
-        data={
-            "client_id": STRAVA_CLIENT_ID,
-            "client_secret": STRAVA_CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-        },
-    )
+    try:
+        with span("strava.token_exchange"):
+            response = await strava.request_token(
+                data={
+                    "client_id": STRAVA_CLIENT_ID,
+                    "client_secret": STRAVA_CLIENT_SECRET,
+                    "code": code,
+                    "grant_type": "authorization_code",
+                },
+            )
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(f"Ошибка соединения со Strava при обмене code на токен: {e!r}")
+        return "Ошибка при авторизации в Strava.", 502
 
     if response.status_code == 200:
         tokens = response.json()
         access_token = tokens["access_token"]
         refresh_token = tokens.get("refresh_token")
 
-        logger.info(f"Получен новый access_token: {access_token}")
-        logger.info(f"Получен refresh_token: {refresh_token}")
+        logger.info(
+            f"Получены токены Strava пользователя {user_id}: access {mask(access_token)}, "
+            f"refresh {mask(refresh_token)}, действуют до {tokens.get('expires_at')}"
+        )
+
+        # Сохраняем токены для последующей фоновой работы
+        await database.save_user_tokens(
+            user_id, access_token, refresh_token, tokens.get("expires_at"),
+            athlete_id=(tokens.get("athlete") or {}).get("id"),
+        )
 
         # Получаем данные пользователя
-        athlete_data = get_strava_athlete_data(access_token)
+        with span("get_strava_athlete_data"):
+            athlete_data = await get_strava_athlete_data(access_token, user_id)
 
         if athlete_data:
             athlete_name = f"{athlete_data['firstname']} {athlete_data['lastname']}"
-            await application.bot.send_message(
-                chat_id=user_id,
-                text=f"Вы успешно авторизовались в Strava! 🎉\nВаш профиль: {athlete_name}",
-            )
+            await notify(user_id, f"Вы успешно авторизовались в Strava! 🎉\nВаш профиль: {athlete_name}")
 
-            # Обрабатываем активности пользователя
-            await process_activities(user_id, access_token)
+            # Активности обрабатываются в фоне, ответ браузеру уходит сразу
+            if not schedule_sync(user_id, access_token):
+                await notify(user_id, "Сейчас слишком много запросов. Авторизуйтесь ещё раз чуть позже.")
         else:
-            await application.bot.send_message(
-                chat_id=user_id,
-                text="Ошибка получения данных пользователя Strava. Попробуйте позже.",
-            )
+            await notify(user_id, "Ошибка получения данных пользователя Strava. Попробуйте позже.")
         return "Авторизация прошла успешно. Вернитесь в Telegram!"
     else:
-        logger.error(f"Ошибка при обмене code на токен: {response.text}")
+        logger.error(f"Ошибка при обмене code на токен: {response.status_code} {truncate(response.text)}")
         return "Ошибка при авторизации в Strava.", 400
 
+# События подписки не подписаны, поэтому отзыв доступа подтверждаем у самой Strava:
+# действующий токен пользователя должен получить 401 на /athlete, а истекший —
+# отказ в обновлении (после отказа планировщик стирает refresh_token).
+# Если токен получить или проверить не удалось, отзыв не считается подтверждённым.
+async def is_access_revoked(user_id):
+    access_token = await token_refresher.get_access_token(user_id)
+    if not access_token:
+        user = await database.get_user(user_id)
+        return user is not None and not user[2]
+    # Ответ /athlete мог остаться в кэше с тех пор, когда доступ ещё был
+    await strava.cache.invalidate(scope=user_id, path="/athlete")
+    try:
+        response = await strava.get("/athlete", access_token, cache_scope=user_id)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.error(
+            "Ошибка соединения со Strava при проверке доступа пользователя %s: %r", user_id, e,
+            extra={"user_id": user_id},
+        )
+        return False
+    return response.status_code == 401
+
+# Обработка события push-подписки Strava
+async def handle_strava_event(event):
+    with start_trace("strava_event", object_type=event.get("object_type"), aspect_type=event.get("aspect_type")):
+        await _handle_strava_event(event)
+
+async def _handle_strava_event(event):
+    object_type = event.get("object_type")
+    object_id = event.get("object_id")
+    aspect_type = event.get("aspect_type")
+    user_id = await database.get_user_id_by_athlete(event.get("owner_id"))
+    if user_id is None:
+        logger.info("Событие Strava для неизвестного атлета %s пропущено", event.get("owner_id"))
+        return
+
+    if object_type == "athlete":
+        if (event.get("updates") or {}).get("authorized") == "false":
+            if not await is_access_revoked(user_id):
+                logger.warning(
+                    "Strava не подтвердила отзыв доступа пользователем %s, данные сохранены", user_id,
+                    extra={"user_id": user_id},
+                )
+                return
+            await database.delete_user(user_id)
+            logger.info("Пользователь %s отозвал доступ в Strava, данные удалены", user_id, extra={"user_id": user_id})
+        return
+
+    if object_type != "activity":
+        return
+    if aspect_type == "delete":
+        await database.delete_activities(user_id, [object_id])
+        await strava.cache.invalidate(scope=user_id, path=f"/activities/{object_id}")
+    elif aspect_type == "update":
+        await strava.cache.invalidate(scope=user_id, path=f"/activities/{object_id}")
+    elif aspect_type == "create":
+        # Новая активность: инкрементальная синхронизация заберёт её вместе с фото.
+        # Синхронизация идёт в фоновом воркере, чтобы не занимать воркер событий
+        access_token = await token_refresher.get_access_token(user_id)
+        if access_token:
+            schedule_sync(user_id, access_token, quiet=True)
+
+strava_events = StravaEventQueue(handle_strava_event)
+
+# Проверка подписки Strava: возвращаем hub.challenge, если verify_token совпал
+@app.get("/strava_webhook")
+async def strava_webhook_validate():
+    challenge = validate_subscription(request.args)
+    if challenge is None:
+        logger.warning("Неверный запрос проверки подписки Strava")
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify({"hub.challenge": challenge})
+
+# Идентификатор из события Strava: целое в диапазоне INTEGER SQLite
+def is_strava_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
+# События подписки Strava: ставим в очередь и сразу отвечаем (Strava ждёт ответа не дольше 2 с).
+# Без STRAVA_SUBSCRIPTION_ID приём отключён: проверить происхождение события нечем.
+@app.post("/strava_webhook")
+async def strava_webhook():
+    if not strava_events.subscription_id:
+        return jsonify({"status": "disabled"}), 404
+    event = await request.get_json(silent=True)
+    if not isinstance(event, dict) or "object_type" not in event:
+        return jsonify({"status": "error"}), 400
+    # Тело не подписано: идентификаторы проверяем до того, как они попадут в базу
+    if not is_strava_id(event.get("object_id")) or not is_strava_id(event.get("owner_id")):
+        return jsonify({"status": "error"}), 400
+    if not strava_events.put(event):
+        return jsonify({"status": "busy"}), 503
+    return jsonify({"status": "ok"})
+
 # Главная точка запуска приложения
 if __name__ == "__main__":
     asyncio.run(application.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook"))
@@ -0,0 +1,44 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+
+# Ключ подписи должен совпадать на всех воркерах и репликах.
+# Если отдельный ключ не задан, он выводится из секрета приложения Strava.
+OAUTH_STATE_SECRET = os.environ.get('OAUTH_STATE_SECRET') or os.environ.get('STRAVA_CLIENT_SECRET', '')
+# Сколько секунд state остаётся действительным
+OAUTH_STATE_TTL = int(os.environ.get('OAUTH_STATE_TTL', 600))
+# Допустимое расхождение часов между репликами
+CLOCK_SKEW = 60
+
+
+def _signature(payload, secret):
+    digest = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+# Подписанный state вида "<user_id>.<время выдачи>.<nonce>.<подпись>".
+# Проверяется без обращения к какому-либо хранилищу.
+def sign_state(user_id, secret=OAUTH_STATE_SECRET, now=None):
+    issued_at = int(now if now is not None else time.time())
+    payload = f"{user_id}.{issued_at}.{secrets.token_urlsafe(8)}"
+    return f"{payload}.{_signature(payload, secret)}"
+
+
+# Возвращает user_id из state или None, если подпись неверна или срок истёк
+def verify_state(state, secret=OAUTH_STATE_SECRET, ttl=OAUTH_STATE_TTL, now=None):
+    try:
+        payload, signature = state.rsplit(".", 1)
+        user_id, issued_at, _ = payload.split(".")
+        user_id, issued_at = int(user_id), int(issued_at)
+    except (AttributeError, ValueError):
+        return None
+    # Сравниваем байты: для str compare_digest падает на не-ASCII символах
+    if not hmac.compare_digest(signature.encode(), _signature(payload, secret).encode()):
+        return None
+    now = now if now is not None else time.time()
+    if not issued_at - CLOCK_SKEW <= now <= issued_at + ttl:
+        return None
+    return user_id
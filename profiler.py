@@ -0,0 +1,214 @@
+import os
+import sys
+import math
+import time
+import signal
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Предельная длительность одного профилирования (секунды)
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))
+# Интервал между снимками стеков при профилировании CPU
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+# Глубина стека, которую запоминает tracemalloc для каждого выделения
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', 10))
+
+
+# Профилирование уже идёт: одновременно допускается только одно
+class ProfilerBusyError(Exception):
+    pass
+
+
+# Поток ждёт событий в селекторе — простаивает, а не работает
+def _is_idle(frame):
+    return frame.f_code.co_filename.endswith("selectors.py")
+
+
+def _line_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+
+def _function_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+# Накопитель снимков стеков: self — строка, на которой стоял поток,
+# total — функции, присутствовавшие в стеке (рекурсия считается один раз)
+class StackStats:
+    def __init__(self):
+        self.samples = 0
+        self.idle = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+
+    def add(self, frame):
+        self.samples += 1
+        if _is_idle(frame):
+            self.idle += 1
+            return
+        self.self_counts[_line_key(frame)] += 1
+        seen = set()
+        while frame is not None:
+            key = _function_key(frame)
+            if key not in seen:
+                seen.add(key)
+                self.total_counts[key] += 1
+            frame = frame.f_back
+
+    def _top(self, counter, limit):
+        return [
+            {"frame": key, "samples": count, "percent": round(100 * count / self.samples, 2)}
+            for key, count in counter.most_common(limit)
+        ]
+
+    def result(self, top):
+        return {
+            "samples": self.samples,
+            "idle_percent": round(100 * self.idle / self.samples, 2) if self.samples else None,
+            "top_self": self._top(self.self_counts, top),
+            "top_total": self._top(self.total_counts, top),
+        }
+
+
+# Профилировщик по запросу. Пока не запущен, ничего не стоит: нет ни таймера, ни потока,
+# ни трассировки выделений; код приложения не инструментируется.
+# CPU потока event loop профилируется сэмплированием по SIGPROF (таймер процессорного
+# времени, обработчик выполняется в самом потоке loop). Сэмплирование из отдельного потока
+# здесь не годится: из-за GIL снимки попадали бы только на моменты, когда loop ждёт в select.
+# Для всех потоков (или если сигналы недоступны) остаётся сэмплирование из потока
+# по настенным часам; память — через tracemalloc на время замера.
+class Profiler:
+    def __init__(self, max_seconds=PROFILE_MAX_SECONDS, sample_interval=PROFILE_SAMPLE_INTERVAL,
+                 tracemalloc_frames=PROFILE_TRACEMALLOC_FRAMES):
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.tracemalloc_frames = tracemalloc_frames
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def _acquire(self):
+        if self._running:
+            raise ProfilerBusyError()
+        self._running = True
+
+    # Длительность в пределах max_seconds; nan и inf не допускаются
+    def _seconds(self, seconds):
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise ValueError(f"Некорректная длительность профилирования: {seconds}")
+        return min(seconds, self.max_seconds)
+
+    @staticmethod
+    def _can_use_signals():
+        return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+    async def _sample_signals(self, seconds, interval):
+        stats = StackStats()
+        previous = signal.signal(signal.SIGPROF, lambda signum, frame: stats.add(frame))
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+        return stats, {threading.current_thread().name: stats.samples}
+
+    # Снимки стеков всех потоков, кроме своего, в течение seconds секунд
+    def _sample_threads(self, seconds, interval):
+        own_thread = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stats = StackStats()
+        by_thread = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    by_thread[thread_names.get(thread_id, str(thread_id))] += 1
+                    stats.add(frame)
+            time.sleep(interval)
+        return stats, dict(by_thread)
+
+    # all_threads=False — только поток event loop (тот, что вызвал cpu())
+    async def cpu(self, seconds, top=30, interval=None, all_threads=False):
+        seconds = self._seconds(seconds)
+        interval = max(interval or self.sample_interval, 0.001)
+        if not math.isfinite(interval):
+            raise ValueError(f"Некорректный интервал профилирования: {interval}")
+        self._acquire()
+        try:
+            clock = "cpu" if not all_threads and self._can_use_signals() else "wall"
+            logger.info(f"Профилирование CPU на {seconds} с, интервал {interval} с ({clock})")
+            if clock == "cpu":
+                stats, threads = await self._sample_signals(seconds, interval)
+            else:
+                stats, threads = await asyncio.get_running_loop().run_in_executor(
+                    None, self._sample_threads, seconds, interval,
+                )
+        finally:
+            self._running = False
+        return {
+            "mode": "cpu",
+            "clock": clock,
+            "seconds": seconds,
+            "interval": interval,
+            "threads": threads,
+            **stats.result(top),
+        }
+
+    # Выделения памяти за seconds секунд: разница снимков tracemalloc по строкам кода
+    async def memory(self, seconds, top=30):
+        seconds = self._seconds(seconds)
+        self._acquire()
+        loop = asyncio.get_running_loop()
+        started_here = not tracemalloc.is_tracing()
+        try:
+            logger.info(f"Профилирование памяти на {seconds} с")
+            if started_here:
+                tracemalloc.start(self.tracemalloc_frames)
+            # Снимки и их сравнение — тяжёлая работа (копия всех трасс), выносим её из event loop
+            before = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+            await asyncio.sleep(seconds)
+            after = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+            current, peak = tracemalloc.get_traced_memory()
+            stats = await loop.run_in_executor(None, self._compare, before, after)
+        finally:
+            if started_here:
+                tracemalloc.stop()
+            self._running = False
+        return {
+            "mode": "memory",
+            "seconds": seconds,
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "top_allocations": [
+                {
+                    "location": str(stat.traceback[0]),
+                    "size_diff_bytes": stat.size_diff,
+                    "size_bytes": stat.size,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:top]
+            ],
+        }
+
+    @staticmethod
+    def _compare(before, after):
+        filters = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+        return after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+
+
+# Общий профилировщик процесса
+profiler = Profiler()
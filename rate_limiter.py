@@ -0,0 +1,174 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: чем меньше число, тем раньше запрос уйдёт в Strava
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Окна лимитов Strava: 15-минутные интервалы (0, 15, 30, 45 минут) и сутки по UTC
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+
+STRAVA_SHORT_LIMIT = int(os.environ.get('STRAVA_SHORT_LIMIT', 200))
+STRAVA_LONG_LIMIT = int(os.environ.get('STRAVA_LONG_LIMIT', 2000))
+# Доля квоты, которую мы позволяем себе израсходовать (запас на запросы в полёте)
+STRAVA_LIMIT_MARGIN = float(os.environ.get('STRAVA_LIMIT_MARGIN', 0.95))
+# Сколько запросов подряд можно отправить без сглаживания
+STRAVA_BURST = int(os.environ.get('STRAVA_BURST', 10))
+
+
+# Разбор заголовка вида "600,30000"
+def _parse_pair(value):
+    try:
+        short, long = (int(part) for part in value.split(","))
+        return short, long
+    except (AttributeError, ValueError):
+        return None
+
+
+# Планировщик запросов к Strava с учётом 15-минутной и суточной квоты.
+# Запросы ждут в очереди по приоритету, а скорость выдачи подстраивается так,
+# чтобы оставшейся квоты хватило до конца обоих окон.
+class StravaRateLimiter:
+    def __init__(self, short_limit=STRAVA_SHORT_LIMIT, long_limit=STRAVA_LONG_LIMIT,
+                 margin=STRAVA_LIMIT_MARGIN, burst=STRAVA_BURST):
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.short_usage = 0
+        self.long_usage = 0
+        self.margin = margin
+        self.burst = burst
+        self.tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._short_window = self._window_index(SHORT_WINDOW)
+        self._long_window = self._window_index(LONG_WINDOW)
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    @staticmethod
+    def _window_index(length):
+        return int(time.time() // length)
+
+    @staticmethod
+    def _until_reset(length):
+        return length - time.time() % length
+
+    # Сброс локальных счётчиков при смене окна
+    def _roll_windows(self):
+        short_window = self._window_index(SHORT_WINDOW)
+        if short_window != self._short_window:
+            self._short_window = short_window
+            self.short_usage = 0
+        long_window = self._window_index(LONG_WINDOW)
+        if long_window != self._long_window:
+            self._long_window = long_window
+            self.long_usage = 0
+
+    def _remaining(self):
+        short = int(self.short_limit * self.margin) - self.short_usage
+        long = int(self.long_limit * self.margin) - self.long_usage
+        return short, long
+
+    # Сколько секунд ждать до следующего разрешённого запроса
+    def _delay(self):
+        self._roll_windows()
+        short_left, long_left = self._remaining()
+        if long_left <= 0:
+            return self._until_reset(LONG_WINDOW)
+        if short_left <= 0:
+            return self._until_reset(SHORT_WINDOW)
+
+        # Скорость пополнения: остаток квоты равномерно до конца 15-минутного окна.
+        # Суточная квота работает как жёсткий потолок и не даёт потратить больше остатка.
+        rate = min(short_left, long_left) / self._until_reset(SHORT_WINDOW)
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / rate
+
+    def _consume(self):
+        self.tokens -= 1
+        self.short_usage += 1
+        self.long_usage += 1
+
+    async def _dispatch_loop(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = self._delay()
+            if delay > 0:
+                # Спим короткими отрезками, чтобы учитывать свежие заголовки
+                await asyncio.sleep(min(delay, 1.0))
+                continue
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue  # Ожидающий отменил запрос
+            self._consume()
+            future.set_result(None)
+
+    # Ожидание разрешения на запрос с заданным приоритетом
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch_loop())
+        future = loop.create_future()
+        heapq.heappush(self._heap, (priority, next(self._counter), future))
+        self._wakeup.set()
+        await future
+
+    # Обновление квоты по заголовкам ответа Strava
+    def update(self, headers, status_code=None):
+        self._roll_windows()
+        limits = _parse_pair(headers.get("X-RateLimit-Limit"))
+        usage = _parse_pair(headers.get("X-RateLimit-Usage"))
+        if limits:
+            self.short_limit, self.long_limit = limits
+        if usage:
+            # Запросы в полёте могли уже учесться локально, поэтому берём максимум
+            self.short_usage = max(self.short_usage, usage[0])
+            self.long_usage = max(self.long_usage, usage[1])
+        if status_code == 429:
+            logger.warning("Strava вернула 429, ждём сброса 15-минутного окна")
+            self.short_usage = max(self.short_usage, self.short_limit)
+
+    # Текущее состояние квоты и очереди для мониторинга
+    def snapshot(self):
+        self._roll_windows()
+        queued = {}
+        for priority, _, future in self._heap:
+            if not future.done():
+                queued[priority] = queued.get(priority, 0) + 1
+        return {
+            "short_limit": self.short_limit,
+            "short_usage": self.short_usage,
+            "short_reset_in": round(self._until_reset(SHORT_WINDOW)),
+            "long_limit": self.long_limit,
+            "long_usage": self.long_usage,
+            "long_reset_in": round(self._until_reset(LONG_WINDOW)),
+            "queue_depth": sum(queued.values()),
+            "queued_by_priority": queued,
+        }
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, future in self._heap:
+            future.cancel()
+        self._heap.clear()
@@ -0,0 +1,154 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 10))
+# Retry-After длиннее этого не ждём: запрос возвращается вызывающему как есть
+RETRY_AFTER_LIMIT = float(os.environ.get('RETRY_AFTER_LIMIT', 30))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Вызов отклонён без обращения к сервису: автомат разомкнут
+class CircuitOpenError(Exception):
+    def __init__(self, name):
+        super().__init__(f"Сервис {name} временно недоступен (circuit breaker разомкнут)")
+        self.name = name
+
+
+# Автомат защиты: после failure_threshold ошибок подряд перестаёт пропускать вызовы
+# на reset_timeout секунд, затем пропускает один пробный вызов.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"{self.name}: сервис снова отвечает, автомат замкнут")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+
+    # Вызов завершился без вердикта (отмена, посторонняя ошибка): освобождаем пробный слот
+    def release(self):
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"{self.name}: {self.consecutive_failures} ошибок подряд, автомат разомкнут")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+# Задержка перед повтором: экспоненциальная с полным джиттером
+def backoff_delay(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+# Внешний сервис (Strava, Telegram) с общими для всех вызовов повторами и автоматом защиты
+class Upstream:
+    def __init__(self, name, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    # Вызов func() с повторами.
+    # is_failure(exc) — считать ли исключение сбоем сервиса;
+    # can_retry(exc) — можно ли повторить вызов после такого сбоя (по умолчанию да);
+    # failed_result(result) — считать ли ответ сбоем (например, 5xx);
+    # retry_after(result) — сколько ждать перед повтором по ответу сервиса (или None).
+    # attempts=1 — только автомат защиты, без повторов (для неидемпотентных вызовов).
+    async def call(self, func, is_failure=None, can_retry=None, failed_result=None, retry_after=None,
+                   attempts=None):
+        attempts = attempts or self.attempts
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                self.rejected += 1
+                raise CircuitOpenError(self.name)
+            self.calls += 1
+            last_attempt = attempt == attempts - 1
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if is_failure is None or not is_failure(e):
+                    self.breaker.release()
+                    raise
+                self.failures += 1
+                self.breaker.record_failure()
+                if last_attempt or (can_retry is not None and not can_retry(e)):
+                    raise
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                logger.warning("%s: ошибка %r, повтор через %.2f с", self.name, e, delay)
+            else:
+                if failed_result is None or not failed_result(result):
+                    self.breaker.record_success()
+                    return result
+                self.failures += 1
+                self.breaker.record_failure()
+                wait = retry_after(result) if retry_after else None
+                if last_attempt or (wait is not None and wait > RETRY_AFTER_LIMIT):
+                    return result
+                delay = wait if wait is not None else backoff_delay(attempt, self.base_delay, self.max_delay)
+                logger.warning("%s: неудачный ответ, повтор через %.2f с", self.name, delay)
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def snapshot(self):
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+# Все внешние сервисы приложения по имени — для мониторинга
+upstreams = {}
+
+
+def get_upstream(name, **kwargs):
+    if name not in upstreams:
+        upstreams[name] = Upstream(name, **kwargs)
+    return upstreams[name]
@@ -0,0 +1,88 @@
+import os
+import re
+import time
+import hashlib
+import logging
+from urllib.parse import urlencode
+from db import database
+
+logger = logging.getLogger(__name__)
+
+# Время жизни закэшированных ответов по эндпоинтам Strava (секунды).
+# Эндпоинты, которых нет в списке, не кэшируются.
+CACHE_TTLS = [
+    (re.compile(r"^/athlete$"), int(os.environ.get('CACHE_TTL_ATHLETE', 60 * 60))),
+    (re.compile(r"^/activities/\d+/photos$"), int(os.environ.get('CACHE_TTL_PHOTOS', 7 * 24 * 60 * 60))),
+]
+# Предельный суммарный размер тел ответов в кэше
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Время последнего чтения обновляем не чаще, чем раз в TOUCH_INTERVAL секунд
+TOUCH_INTERVAL = 60
+# Вытеснение запускается после каждых EVICT_EVERY записей
+EVICT_EVERY = 100
+
+
+# Кэш GET-ответов Strava в users.db с TTL по эндпоинтам и LRU-вытеснением по размеру.
+# scope отделяет данные разных пользователей; если он не задан, берётся хэш токена.
+class ResponseCache:
+    def __init__(self, ttls=CACHE_TTLS, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    def ttl_for(self, path):
+        for pattern, ttl in self.ttls:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    @staticmethod
+    def scope_for(access_token, scope=None):
+        if scope is not None:
+            return str(scope)
+        return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def key(scope, path, params=None):
+        query = urlencode(sorted(params.items())) if params else ""
+        return f"{scope}:{path}?{query}"
+
+    # Тело ответа из кэша или None
+    async def get(self, key):
+        row = await database.get_cached_response(key)
+        now = time.time()
+        if row is None or row[1] <= now:
+            self.misses += 1
+            return None
+        body, _, accessed_at = row
+        if now - accessed_at > TOUCH_INTERVAL:
+            await database.touch_cached_response(key, now)
+        self.hits += 1
+        return body
+
+    async def set(self, key, scope, path, body, ttl):
+        now = time.time()
+        await database.save_cached_response(key, scope, path, body, now + ttl, now)
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            evicted = await database.evict_cached_responses(now, self.max_bytes)
+            if evicted:
+                logger.info(f"Из кэша ответов Strava вытеснено записей: {evicted}")
+
+    # Хук инвалидации: все записи пользователя и/или пути (например, "/activities/123")
+    async def invalidate(self, scope=None, path=None):
+        deleted = await database.delete_cached_responses(
+            scope=str(scope) if scope is not None else None, path=path,
+        )
+        logger.info("Инвалидация кэша Strava (scope=%s, path=%s): удалено %s", scope, path, deleted)
+        return deleted
+
+    def snapshot(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
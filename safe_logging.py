@@ -0,0 +1,112 @@
+import os
+import re
+import logging
+
+# Предельная длина итогового сообщения лога (всё сверх обрезается)
+LOG_MESSAGE_LIMIT = int(os.environ.get('LOG_MESSAGE_LIMIT', 2000))
+# Предельная длина тела ответа или другой полезной нагрузки внутри сообщения
+LOG_PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', 200))
+# Одно место в коде пишет не больше LOG_REPEAT_BURST предупреждений и ошибок
+# за LOG_REPEAT_WINDOW секунд, остальные подавляются и подсчитываются
+LOG_REPEAT_WINDOW = float(os.environ.get('LOG_REPEAT_WINDOW', 60))
+LOG_REPEAT_BURST = int(os.environ.get('LOG_REPEAT_BURST', 5))
+
+# Секреты, которые могут попасть в сообщения: токен бота в URL Bot API,
+# заголовок Authorization и токены OAuth в теле запроса или JSON
+SECRET_PATTERN = re.compile(
+    r"(?P<bot>/bot)\d+:[\w-]+"
+    r"|(?P<bearer>Bearer\s+)[\w.~+/-]+=*"
+    r"|(?P<field>\b(?:access_token|refresh_token|client_secret)\b['\"]?\s*[:=]\s*['\"]?)[^\s'\"&,}]+"
+)
+
+
+def _redact_match(match):
+    prefix = match.group("bot") or match.group("bearer") or match.group("field")
+    return f"{prefix}<скрыто>"
+
+
+def redact(text):
+    return SECRET_PATTERN.sub(_redact_match, text)
+
+
+def truncate(text, limit=LOG_PAYLOAD_LIMIT):
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}… (+{len(text) - limit} симв.)"
+
+
+# Секрет для лога: только последние символы, чтобы можно было сопоставить записи
+def mask(secret):
+    if not secret:
+        return "<пусто>"
+    return f"…{secret[-4:]}" if len(secret) > 12 else "<скрыто>"
+
+
+# Сводка вместо полного JSON: количество и первые идентификаторы
+def summarize(items, key="id", limit=5):
+    if not items:
+        return "0 шт."
+    ids = ", ".join(str(item.get(key)) for item in items[:limit] if isinstance(item, dict))
+    more = f", … ещё {len(items) - limit}" if len(items) > limit else ""
+    return f"{len(items)} шт.: {ids}{more}"
+
+
+# Отложенное вычисление аргумента лога: func(*args) вызывается, только если запись
+# действительно форматируется (уровень включён), например:
+# logger.debug("Фотографии: %s", Lazy(summarize, photos, "unique_id"))
+class Lazy:
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+# Итоговое сообщение: секреты скрыты, длина ограничена.
+# Сообщение форматируется здесь один раз и сохраняется в записи, поэтому
+# обработчик не форматирует его повторно.
+class RedactingFilter(logging.Filter):
+    def __init__(self, limit=LOG_MESSAGE_LIMIT):
+        super().__init__()
+        self.limit = limit
+
+    def filter(self, record):
+        message = redact(record.getMessage())
+        if len(message) > self.limit:
+            message = truncate(message, self.limit)
+        record.msg = message
+        record.args = None
+        return True
+
+
+# Ограничение повторяющихся предупреждений и ошибок по месту вызова (файл и строка):
+# при сбое внешнего сервиса одна и та же ошибка иначе пишется на каждый запрос
+class RepeatFilter(logging.Filter):
+    def __init__(self, window=LOG_REPEAT_WINDOW, burst=LOG_REPEAT_BURST, level=logging.WARNING):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.level = level
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        site = self._sites.get(key)
+        if site is None or record.created - site[0] >= self.window:
+            suppressed = site[2] if site is not None else 0
+            self._sites[key] = [record.created, 1, 0]
+            if suppressed:
+                record.msg = f"{record.getMessage()} (подавлено повторов за {self.window:g} с: {suppressed})"
+                record.args = None
+            return True
+        site[1] += 1
+        if site[1] <= self.burst:
+            return True
+        site[2] += 1
+        return False
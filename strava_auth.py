@@ -1,10 +1,25 @@
 import os
-import requests
+from strava_client import strava
 
 STRAVA_CLIENT_ID = os.environ.get('STRAVA_CLIENT_ID', '137731')
 STRAVA_CLIENT_SECRET = os.environ.get('STRAVA_CLIENT_SECRET', '7257349b9930aec7f5c2ad6b105f6f24038e9712')
 REDIRECT_URI = os.environ.get('REDIRECT_URI', 'https://mystravabot-production.up.railway.app')
 
+# Strava отклонила refresh_token: доступ отозван или токен недействителен, повторять бессмысленно
+class RefreshTokenRejected(Exception):
+    pass
+
+# Ошибка именно в refresh_token, а не в client_id/client_secret приложения
+def _rejects_refresh_token(response):
+    if response.status_code not in (400, 401):
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    errors = body.get('errors') if isinstance(body, dict) else None
+    return any(isinstance(error, dict) and error.get('field') == 'refresh_token' for error in errors or [])
+
 def get_authorization_url():
     params = {
         'client_id': STRAVA_CLIENT_ID,
@@ -14,9 +29,8 @@ def get_authorization_url():
     }
     return f"https://www.strava.com/oauth/authorize?{'&'.join(f'{k}={v}' for k, v in params.items())}"
 
-def exchange_code_for_token(code):
-    response = requests.post(
-        'https://www.strava.com/oauth/token',
+async def exchange_code_for_token(code):
+    response = await strava.request_token(
         data={
             'client_id': STRAVA_CLIENT_ID,
             'client_secret': STRAVA_CLIENT_SECRET,
@@ -26,13 +40,12 @@ def exchange_code_for_token(code):
     )
     if response.status_code == 200:
         data = response.json()
-        return data['access_token'], data['refresh_token']
+        return data['access_token'], data['refresh_token'], data.get('expires_at')
     else:
-        return None, None
+        return None, None, None
 
-def refresh_access_token(refresh_token):
-    response = requests.post(
-        'https://www.strava.com/oauth/token',
+async def refresh_access_token(refresh_token):
+    response = await strava.request_token(
         data={
             'client_id': STRAVA_CLIENT_ID,
             'client_secret': STRAVA_CLIENT_SECRET,
@@ -42,9 +55,11 @@ def refresh_access_token(refresh_token):
     )
     if response.status_code == 200:
         data = response.json()
-        return data['access_token'], data['refresh_token']
+        return data['access_token'], data['refresh_token'], data.get('expires_at')
+    elif _rejects_refresh_token(response):
+        raise RefreshTokenRejected(response.text)
     else:
-        return None, None
+        return None, None, None
 
 if __name__ == '__main__':
     print(get_authorization_url())
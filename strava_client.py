@@ -0,0 +1,224 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import sqlite3
+import httpx
+from rate_limiter import StravaRateLimiter, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from response_cache import ResponseCache
+from resilience import get_upstream
+from metrics import upstream_request_seconds, strava_rate_limit_wait_seconds
+from tracing import span
+from safe_logging import truncate
+
+logger = logging.getLogger(__name__)
+
+# Настройки подключения к Strava API
+STRAVA_API_URL = os.environ.get('STRAVA_API_URL', 'https://www.strava.com/api/v3')
+STRAVA_OAUTH_URL = os.environ.get('STRAVA_OAUTH_URL', 'https://www.strava.com/oauth/token')
+STRAVA_TIMEOUT = float(os.environ.get('STRAVA_TIMEOUT', 10))
+STRAVA_CONNECT_TIMEOUT = float(os.environ.get('STRAVA_CONNECT_TIMEOUT', 5))
+STRAVA_MAX_CONNECTIONS = int(os.environ.get('STRAVA_MAX_CONNECTIONS', 100))
+STRAVA_MAX_KEEPALIVE = int(os.environ.get('STRAVA_MAX_KEEPALIVE', 20))
+STRAVA_PER_PAGE = int(os.environ.get('STRAVA_PER_PAGE', 200))
+
+ID_IN_PATH = re.compile(r"/\d+")
+
+
+# Сбоем Strava считаются сетевые ошибки и ответы 5xx; 4xx и 429 — нормальные ответы
+def _is_transport_error(error):
+    return isinstance(error, httpx.TransportError)
+
+
+def _is_server_error(response):
+    return response.status_code >= 500
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+# Шаблон пути для меток метрик: идентификаторы заменяются на {id}
+def _endpoint(path):
+    return ID_IN_PATH.sub("/{id}", path)
+
+
+# Ошибка Strava API с кодом ответа
+class StravaError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Strava API {status_code}: {truncate(text)}")
+        self.status_code = status_code
+        self.text = text
+
+
+# Асинхронный клиент Strava с общим пулом keep-alive соединений.
+# Один экземпляр на процесс: открывается при старте приложения и закрывается при остановке.
+class StravaClient:
+    def __init__(self, base_url=STRAVA_API_URL, oauth_url=STRAVA_OAUTH_URL,
+                 timeout=STRAVA_TIMEOUT, connect_timeout=STRAVA_CONNECT_TIMEOUT,
+                 max_connections=STRAVA_MAX_CONNECTIONS, max_keepalive=STRAVA_MAX_KEEPALIVE):
+        self.base_url = base_url
+        self.oauth_url = oauth_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+        )
+        self.limiter = StravaRateLimiter()
+        self.cache = ResponseCache()
+        self.upstream = get_upstream("strava")
+        self._http = None
+        self._inflight = {}
+
+    async def start(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            logger.info("HTTP-клиент Strava запущен")
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            await self.limiter.close()
+            logger.info("HTTP-клиент Strava остановлен")
+
+    # Клиент создаётся лениво, если запрос пришёл до start() (например, из скрипта)
+    async def _client(self):
+        if self._http is None:
+            await self.start()
+        return self._http
+
+    # GET-запрос к Strava API от имени пользователя.
+    # Ответы эндпоинтов с заданным TTL берутся из кэша; cache_scope — владелец данных
+    # (обычно user_id), по умолчанию — хэш токена.
+    # Одновременные одинаковые запросы (путь, параметры, токен) сливаются в один:
+    # все ожидающие получают один и тот же ответ.
+    async def get(self, path, access_token, params=None, timeout=None, priority=PRIORITY_INTERACTIVE,
+                  cache_scope=None):
+        cache_entry = None
+        ttl = self.cache.ttl_for(path)
+        if ttl is not None:
+            scope = self.cache.scope_for(access_token, cache_scope)
+            cache_key = self.cache.key(scope, path, params)
+            cache_entry = (cache_key, scope, ttl)
+            try:
+                body = await self.cache.get(cache_key)
+            except sqlite3.Error as e:
+                logger.error("Ошибка чтения кэша Strava: %r", e)
+                body = None
+            if body is not None:
+                return httpx.Response(
+                    200, content=body.encode(), headers={"Content-Type": "application/json"},
+                    request=httpx.Request("GET", self.base_url + path, params=params),
+                )
+
+        key = (path, tuple(sorted(params.items())) if params else (), access_token)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._get(path, access_token, params, timeout, priority, cache_entry))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    # GET идемпотентен, поэтому сетевые ошибки и 5xx повторяются с джиттером;
+    # каждая попытка ждёт своей очереди в планировщике квоты
+    async def _get(self, path, access_token, params, timeout, priority, cache_entry):
+        http = await self._client()
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        async def attempt():
+            wait_started = time.perf_counter()
+            with span("strava.rate_limit_wait", priority=priority):
+                await self.limiter.acquire(priority)
+            strava_rate_limit_wait_seconds.observe(time.perf_counter() - wait_started)
+            response = await self._timed(
+                _endpoint(path), http.get(path, headers=headers, params=params, timeout=timeout or self.timeout),
+            )
+            self.limiter.update(response.headers, response.status_code)
+            return response
+
+        response = await self.upstream.call(
+            attempt, is_failure=_is_transport_error, failed_result=_is_server_error, retry_after=_retry_after,
+        )
+        if cache_entry and response.status_code == 200:
+            cache_key, scope, ttl = cache_entry
+            try:
+                await self.cache.set(cache_key, scope, path, response.text, ttl)
+            except sqlite3.Error as e:
+                logger.error("Ошибка записи в кэш Strava: %r", e)
+        return response
+
+    # Запрос с записью длительности и статуса в метрики и спан трассировки
+    @staticmethod
+    async def _timed(endpoint, request):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            with span("strava.request", endpoint=endpoint) as current:
+                response = await request
+                status = str(response.status_code)
+                current.set("status", response.status_code)
+            return response
+        finally:
+            upstream_request_seconds.observe(time.perf_counter() - started, "strava", endpoint, status)
+
+    # Постраничная выгрузка активностей атлета.
+    # Следующая страница запрашивается заранее, пока вызывающий обрабатывает текущую.
+    # after/before — границы периода в секундах Unix-времени.
+    # При ошибке Strava выбрасывает StravaError, сетевые ошибки — httpx.HTTPError,
+    # при разомкнутом автомате защиты — CircuitOpenError.
+    async def iter_activities(self, access_token, after=None, before=None,
+                              per_page=STRAVA_PER_PAGE, priority=PRIORITY_BACKGROUND):
+        params = {"per_page": per_page}
+        if after is not None:
+            params["after"] = int(after)
+        if before is not None:
+            params["before"] = int(before)
+
+        async def fetch_page(page):
+            response = await self.get(
+                "/athlete/activities", access_token,
+                params={**params, "page": page}, priority=priority,
+            )
+            if response.status_code != 200:
+                raise StravaError(response.status_code, response.text)
+            return response.json()
+
+        page = 1
+        pending = asyncio.ensure_future(fetch_page(page))
+        try:
+            while pending is not None:
+                activities = await pending
+                pending = None
+                if not activities:
+                    break
+                logger.info(
+                    "Получено активностей на странице %s: %s", page, len(activities),
+                    extra={"page": page, "activities": len(activities)},
+                )
+                if len(activities) >= per_page:
+                    page += 1
+                    pending = asyncio.ensure_future(fetch_page(page))
+                for activity in activities:
+                    yield activity
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+
+    # Запрос к OAuth-эндпоинту (обмен code или refresh_token на токены).
+    # code одноразовый, поэтому без повторов — только автомат защиты.
+    async def request_token(self, data, timeout=None):
+        http = await self._client()
+        return await self.upstream.call(
+            lambda: self._timed("/oauth/token", http.post(self.oauth_url, data=data, timeout=timeout or self.timeout)),
+            is_failure=_is_transport_error, failed_result=_is_server_error, attempts=1,
+        )
+
+
+# Общий экземпляр клиента для всего приложения
+strava = StravaClient()
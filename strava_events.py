@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Токен, который мы указали при создании подписки Strava (проверяется при валидации)
+STRAVA_VERIFY_TOKEN = os.environ.get('STRAVA_VERIFY_TOKEN', '')
+# Id нашей подписки. События Strava не подписаны, и сверка id подписки — единственная
+# защита от поддельных событий, поэтому без него события не принимаются.
+STRAVA_SUBSCRIPTION_ID = os.environ.get('STRAVA_SUBSCRIPTION_ID')
+STRAVA_EVENT_QUEUE_SIZE = int(os.environ.get('STRAVA_EVENT_QUEUE_SIZE', 1000))
+STRAVA_EVENT_WORKERS = int(os.environ.get('STRAVA_EVENT_WORKERS', 2))
+# Сколько последних событий помним для отсева повторных доставок
+STRAVA_EVENT_DEDUP_SIZE = int(os.environ.get('STRAVA_EVENT_DEDUP_SIZE', 10000))
+
+
+# Ответ на проверку подписки: challenge, если verify_token совпал, иначе None
+def validate_subscription(args, verify_token=STRAVA_VERIFY_TOKEN):
+    if args.get("hub.mode") != "subscribe" or not verify_token:
+        return None
+    if args.get("hub.verify_token") != verify_token:
+        return None
+    return args.get("hub.challenge")
+
+
+# Очередь событий push-подписки Strava.
+# Strava может доставить одно событие несколько раз, поэтому недавние события
+# запоминаются и повторы отбрасываются; обработку выполняет handler(event) в воркерах.
+class StravaEventQueue:
+    def __init__(self, handler, maxsize=STRAVA_EVENT_QUEUE_SIZE, workers=STRAVA_EVENT_WORKERS,
+                 dedup_size=STRAVA_EVENT_DEDUP_SIZE, subscription_id=STRAVA_SUBSCRIPTION_ID):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.dedup_size = dedup_size
+        self.subscription_id = subscription_id
+        self.duplicates = 0
+        self._seen = OrderedDict()
+        self._queue = None
+        self._tasks = []
+
+    @staticmethod
+    def event_key(event):
+        return (
+            event.get("object_type"), event.get("object_id"),
+            event.get("aspect_type"), event.get("event_time"),
+        )
+
+    # Постановка события в очередь. Возвращает False, если очередь переполнена
+    # (тогда Strava доставит событие повторно); чужие и повторные события молча пропускаются.
+    def put(self, event):
+        if not self.subscription_id or str(event.get("subscription_id")) != self.subscription_id:
+            logger.warning("Событие чужой подписки %s отброшено", event.get("subscription_id"))
+            return True
+        key = self.event_key(event)
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning("Очередь событий Strava переполнена, событие %s отклонено", key)
+            return False
+        self._seen[key] = True
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def _worker(self):
+        while True:
+            event = await self._queue.get()
+            try:
+                await self.handler(event)
+            except Exception:
+                logger.exception("Ошибка обработки события Strava %s", self.event_key(event))
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self):
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "duplicates": self.duplicates,
+        }
@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+import httpx
+from telegram.error import RetryAfter, NetworkError, BadRequest
+from resilience import get_upstream, CircuitOpenError
+from metrics import upstream_request_seconds
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 сообщение в секунду на чат
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+# Сколько раз повторяем отправку после ответа RetryAfter
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))
+
+
+# Сетевые ошибки Telegram — сбой сервиса (BadRequest в PTB тоже NetworkError, но это ошибка запроса).
+def _is_network_error(error):
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+# Ошибки httpx, при которых запрос точно не был отправлен
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+# Запрос точно не доставлен: Telegram его отклонил, соединиться не удалось
+# или автомат защиты не пустил вызов. После остальных ошибок доставка неизвестна.
+def is_not_delivered(error):
+    if isinstance(error, (BadRequest, RetryAfter, CircuitOpenError)):
+        return True
+    return isinstance(error.__cause__, NOT_SENT_ERRORS)
+
+
+# Повторяем только те сетевые ошибки, где запрос точно не дошёл (не удалось соединиться
+# или дождаться соединения из пула). После таймаута чтения, обрыва соединения или 5xx
+# сообщение могло быть доставлено, и повтор дал бы дубль.
+def _can_retry(error):
+    return isinstance(error.__cause__, NOT_SENT_ERRORS)
+
+
+# Корзина токенов: rate токенов в секунду, не больше capacity про запас
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._updated_at = time.monotonic()
+
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        self.tokens -= 1
+
+    # Сдвиг следующей отправки на seconds секунд (для RetryAfter)
+    def pause(self, seconds):
+        self.delay()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+# Очередь исходящих сообщений Telegram.
+# У каждого чата своя очередь и свой воркер, поэтому порядок внутри чата сохраняется,
+# а общий лимит бота раздаётся чатам по очереди через FIFO-блокировку.
+class TelegramSender:
+    def __init__(self, bot, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 max_retries=TELEGRAM_MAX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.upstream = get_upstream("telegram")
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._global_lock = None  # Создаётся в работающем event loop
+        self._chats = {}
+
+    # Постановка вызова в очередь чата; возвращает результат вызова
+    async def send(self, chat_id, func, /, *args, **kwargs):
+        if self._global_lock is None:
+            self._global_lock = asyncio.Lock()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = {
+                "queue": deque(),
+                "bucket": TokenBucket(self.chat_rate, 1),
+                "worker": None,
+            }
+        future = asyncio.get_running_loop().create_future()
+        chat["queue"].append((func, args, kwargs, future))
+        if chat["worker"] is None:
+            chat["worker"] = asyncio.ensure_future(self._chat_worker(chat_id, chat))
+        # Спан в контексте отправителя: воркер чата обслуживает вызовы разных трассировок
+        with span(f"telegram.{getattr(func, '__name__', 'call')}", chat_id=chat_id):
+            return await future
+
+    async def _chat_worker(self, chat_id, chat):
+        queue = chat["queue"]
+        bucket = chat["bucket"]
+        try:
+            while queue:
+                func, args, kwargs, future = queue.popleft()
+                if future.done():
+                    continue  # Отправитель перестал ждать
+                await bucket.acquire()
+                async with self._global_lock:
+                    await self._global_bucket.acquire()
+                await self._call(chat_id, bucket, func, args, kwargs, future)
+            # Дожидаемся окна чата, чтобы новая очередь не нарушила лимит
+            await asyncio.sleep(bucket.delay())
+        finally:
+            chat["worker"] = None
+            if queue:
+                chat["worker"] = asyncio.ensure_future(self._chat_worker(chat_id, chat))
+            elif self._chats.get(chat_id) is chat:
+                del self._chats[chat_id]
+
+    # Вызов Bot API с записью длительности в метрики (метод по имени функции бота)
+    @staticmethod
+    async def _timed(func, args, kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            endpoint = getattr(func, "__name__", "unknown")
+            upstream_request_seconds.observe(time.perf_counter() - started, "telegram", endpoint, status)
+
+    async def _call(self, chat_id, bucket, func, args, kwargs, future):
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await self.upstream.call(
+                    lambda: self._timed(func, args, kwargs), is_failure=_is_network_error, can_retry=_can_retry,
+                )
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+                logger.warning(
+                    "Telegram просит подождать %s с перед отправкой в чат %s", e.retry_after, chat_id,
+                    extra={"user_id": chat_id, "retry_after": e.retry_after},
+                )
+                bucket.pause(e.retry_after)
+                await bucket.acquire()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            else:
+                if not future.done():
+                    future.set_result(result)
+                return
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.send(chat_id, self.bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self.send(chat_id, self.bot.send_photo, chat_id=chat_id, photo=photo, **kwargs)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        return await self.send(chat_id, self.bot.send_media_group, chat_id=chat_id, media=media, **kwargs)
+
+    # Длина очередей для мониторинга
+    def snapshot(self):
+        return {
+            "chats": len(self._chats),
+            "queued": sum(len(chat["queue"]) for chat in self._chats.values()),
+        }
+
+    async def close(self):
+        for chat in list(self._chats.values()):
+            for *_, future in chat["queue"]:
+                future.cancel()
+            chat["queue"].clear()
+            if chat["worker"] is not None:
+                chat["worker"].cancel()
+        self._chats.clear()
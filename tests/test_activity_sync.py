@@ -0,0 +1,164 @@
+import time
+import asyncio
+import pytest
+import activity_sync
+from activity_sync import ActivitySync
+from db import Database
+from strava_client import StravaError
+
+
+# Strava с заданным списком активностей; запоминает, с какого момента запрашивали
+# fail_after — сколько активностей отдать до ошибки Strava
+class FakeStrava:
+    def __init__(self, activities, fail_after=None):
+        self.activities = activities
+        self.fail_after = fail_after
+        self.requested_after = []
+
+    async def iter_activities(self, access_token, after=None):
+        self.requested_after.append(after)
+        for index, activity in enumerate(self.activities):
+            if index == self.fail_after:
+                raise StravaError(503, "Server Error")
+            if after is None or activity_sync._to_timestamp(activity["start_date"]) > after:
+                yield activity
+
+
+def make_activity(activity_id, day):
+    return {
+        "id": activity_id,
+        "start_date": f"2024-05-{day:02d}T07:00:00Z",
+        "name": f"Активность {activity_id}",
+        "total_photo_count": 1,
+    }
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = Database(path=str(tmp_path / "users.db"), readers=1)
+    monkeypatch.setattr(activity_sync, "database", database)
+    monkeypatch.setattr(activity_sync, "SYNC_INITIAL_WINDOW", 0)
+    return database
+
+
+# Синхронизация, в которой доставлены только активности из delivered
+async def sync_once(delivered):
+    sync = ActivitySync(1, "token")
+    yielded = []
+    async for activity in sync.run():
+        yielded.append(activity["id"])
+        if activity["id"] in delivered:
+            sync.confirm(activity)
+    await sync.commit()
+    return sync, yielded
+
+
+def test_undelivered_activity_is_synced_again(database, monkeypatch):
+    strava = FakeStrava([make_activity(3, 12), make_activity(2, 11), make_activity(1, 10)])
+    monkeypatch.setattr(activity_sync, "strava", strava)
+
+    async def scenario():
+        try:
+            # Фотографии активности 2 не ушли: ни она, ни курсор за ней не сохраняются
+            sync, yielded = await sync_once(delivered={1, 3})
+            assert yielded == [3, 2, 1]
+            assert sync.complete
+            cursor = await database.get_sync_cursor(1)
+            assert tuple(cursor) == ("2024-05-11T07:00:00Z", 2)
+
+            sync, yielded = await sync_once(delivered={2})
+            assert yielded == [2]
+            assert sync.incremental
+            cursor = await database.get_sync_cursor(1)
+            assert tuple(cursor) == ("2024-05-12T07:00:00Z", 3)
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
+
+
+def test_nothing_is_saved_without_commit(database, monkeypatch):
+    strava = FakeStrava([make_activity(1, 10)])
+    monkeypatch.setattr(activity_sync, "strava", strava)
+
+    async def scenario():
+        try:
+            sync = ActivitySync(1, "token")
+            async for activity in sync.run():
+                sync.confirm(activity)
+            # Вызывающий упал до commit(): активность придёт снова
+            assert await database.get_sync_cursor(1) is None
+            _, yielded = await sync_once(delivered={1})
+            assert yielded == [1]
+            _, yielded = await sync_once(delivered=set())
+            assert yielded == []
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
+
+
+def test_first_sync_is_bounded(database, monkeypatch):
+    strava = FakeStrava([make_activity(1, 10)])
+    monkeypatch.setattr(activity_sync, "strava", strava)
+    monkeypatch.setattr(activity_sync, "SYNC_INITIAL_WINDOW", 30 * 24 * 60 * 60)
+
+    async def scenario():
+        try:
+            started = time.time()
+            _, yielded = await sync_once(delivered=set())
+            # Давняя активность в окно первой синхронизации не попадает
+            assert yielded == []
+            assert strava.requested_after[0] >= started - 30 * 24 * 60 * 60
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
+
+
+def test_interrupted_first_sync_does_not_resend(database, monkeypatch):
+    strava = FakeStrava([make_activity(3, 12), make_activity(2, 11), make_activity(1, 10)], fail_after=2)
+    monkeypatch.setattr(activity_sync, "strava", strava)
+
+    async def scenario():
+        try:
+            sync, yielded = await sync_once(delivered={2, 3})
+            assert yielded == [3, 2]
+            assert not sync.complete
+            assert await database.get_sync_cursor(1) is None
+
+            strava.fail_after = None
+            _, yielded = await sync_once(delivered={1})
+            assert yielded == [1]
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
+
+
+def test_activity_with_added_photos_is_synced_again(database, monkeypatch):
+    activity = make_activity(1, 10)
+    strava = FakeStrava([activity])
+    monkeypatch.setattr(activity_sync, "strava", strava)
+
+    async def scenario():
+        try:
+            await sync_once(delivered={1})
+            _, yielded = await sync_once(delivered={1})
+            assert yielded == []
+
+            activity["total_photo_count"] = 3
+            sync = ActivitySync(1, "token")
+            async for added in sync.run():
+                assert sync.known_photo_count(added) == 1
+            await sync.commit()
+            assert sync.updated == 1
+            # Не подтвердили доставку — активность придёт снова
+            _, yielded = await sync_once(delivered={1})
+            assert yielded == [1]
+            _, yielded = await sync_once(delivered=set())
+            assert yielded == []
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,17 @@
+import asyncio
+import pytest
+from db import Database
+
+
+def test_failed_write_does_not_stop_writer(tmp_path):
+    async def scenario():
+        database = Database(path=str(tmp_path / "users.db"), readers=1)
+        try:
+            with pytest.raises(OverflowError):
+                await database.save_activities(1, [(2 ** 70, "2024-05-10T07:00:00Z", "Активность", 0)])
+            await asyncio.wait_for(database.set_sync_cursor(1, "2024-05-10T07:00:00Z", 2, 0), 5)
+            assert tuple(await database.get_sync_cursor(1)) == ("2024-05-10T07:00:00Z", 2)
+        finally:
+            await asyncio.wait_for(database.close(), 5)
+
+    asyncio.run(scenario())
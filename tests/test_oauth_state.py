@@ -0,0 +1,11 @@
+from oauth_state import sign_state, verify_state
+
+
+def test_signed_state_round_trip():
+    assert verify_state(sign_state(42, secret="s"), secret="s") == 42
+    assert verify_state(sign_state(42, secret="s"), secret="other") is None
+
+
+def test_non_ascii_state_is_rejected():
+    assert verify_state("1.2.3.é", secret="s") is None
+    assert verify_state("1.2.é.abc", secret="s") is None
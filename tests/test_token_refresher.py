@@ -0,0 +1,61 @@
+import time
+import asyncio
+import pytest
+import token_refresher
+from db import Database
+from strava_auth import RefreshTokenRejected
+from token_refresher import TokenRefresher
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = Database(path=str(tmp_path / "users.db"), readers=1)
+    monkeypatch.setattr(token_refresher, "database", database)
+    return database
+
+
+def test_only_one_refresher_calls_strava(database, monkeypatch):
+    calls = []
+
+    async def refresh_access_token(refresh_token):
+        calls.append(refresh_token)
+        await asyncio.sleep(0.2)
+        return "access-2", "refresh-2", int(time.time()) + 6 * 60 * 60
+
+    monkeypatch.setattr(token_refresher, "refresh_access_token", refresh_access_token)
+    monkeypatch.setattr(token_refresher, "TOKEN_REFRESH_POLL", 0.05)
+
+    async def scenario():
+        try:
+            await database.save_user_tokens(1, "access-1", "refresh-1", int(time.time()) + 60)
+            # Два планировщика — как в двух воркерах с общей базой
+            results = await asyncio.gather(TokenRefresher().refresh(1), TokenRefresher().refresh(1))
+            assert results == ["access-2", "access-2"]
+            assert calls == ["refresh-1"]
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
+
+
+def test_rejected_refresh_token_is_not_retried(database, monkeypatch):
+    calls = []
+
+    async def refresh_access_token(refresh_token):
+        calls.append(refresh_token)
+        raise RefreshTokenRejected("invalid refresh_token")
+
+    monkeypatch.setattr(token_refresher, "refresh_access_token", refresh_access_token)
+
+    async def scenario():
+        try:
+            await database.save_user_tokens(1, "access-1", "refresh-1", int(time.time()) + 60)
+            refresher = TokenRefresher(lease=0)
+            assert await refresher.refresh(1) is None
+            assert await refresher.refresh_due() == 0
+            assert calls == ["refresh-1"]
+            assert (await database.get_user(1))[2] is None
+        finally:
+            await database.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,155 @@
+import os
+import time
+import asyncio
+import logging
+import httpx
+from db import database
+from strava_auth import refresh_access_token, RefreshTokenRejected
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Токен обновляется за TOKEN_REFRESH_MARGIN секунд до истечения плюс индивидуальный
+# сдвиг до TOKEN_REFRESH_SPREAD секунд, чтобы обновления не шли все разом.
+# Strava возвращает новый токен, только если старому осталось меньше часа.
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 10 * 60))
+TOKEN_REFRESH_SPREAD = int(os.environ.get('TOKEN_REFRESH_SPREAD', 30 * 60))
+# Как часто проверять базу на истекающие токены
+TOKEN_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REFRESH_INTERVAL', 60))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', 4))
+# На сколько секунд процесс захватывает обновление токена пользователя. После неудачной
+# попытки захват не снимается, так что следующая будет не раньше чем через это время.
+TOKEN_REFRESH_LEASE = int(os.environ.get('TOKEN_REFRESH_LEASE', 60))
+# Процесс, не захвативший обновление, до TOKEN_REFRESH_WAIT секунд ждёт нового токена в базе,
+# проверяя её каждые TOKEN_REFRESH_POLL секунд
+TOKEN_REFRESH_WAIT = 10
+TOKEN_REFRESH_POLL = 0.5
+
+
+# Планировщик обновления токенов Strava.
+# Одновременные запросы на обновление одного пользователя сливаются в один вызов,
+# иначе второй вызов потратил бы квоту и мог бы получить уже отозванный refresh_token.
+# Между процессами (несколько воркеров hypercorn) то же обеспечивает захват строки в базе:
+# обновляет тот, кто захватил, остальные ждут нового токена в базе.
+# Отклонённый Strava refresh_token стирается, и пользователь больше не обновляется.
+class TokenRefresher:
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN, spread=TOKEN_REFRESH_SPREAD,
+                 interval=TOKEN_REFRESH_INTERVAL, concurrency=TOKEN_REFRESH_CONCURRENCY,
+                 lease=TOKEN_REFRESH_LEASE):
+        self.margin = margin
+        self.spread = spread
+        self.interval = interval
+        self.concurrency = concurrency
+        self.lease = lease
+        self._inflight = {}
+        self._task = None
+
+    # Детерминированный сдвиг пользователя внутри окна spread
+    def _offset(self, user_id):
+        return (user_id * 2654435761) % (self.spread + 1)
+
+    def _due_at(self, user_id, expires_at):
+        return expires_at - self.margin - self._offset(user_id)
+
+    # Обновление токена пользователя; возвращает новый access_token или None
+    async def refresh(self, user_id):
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    async def _refresh(self, user_id):
+        user = await database.get_user(user_id)
+        if user is None or not user[2]:
+            return None
+        now = int(time.time())
+        if not await database.claim_token_refresh(user_id, user[2], now, now + self.lease):
+            return await self._wait_for_refresh(user)
+        try:
+            access_token, refresh_token, expires_at = await refresh_access_token(user[2])
+        except RefreshTokenRejected as e:
+            await database.clear_refresh_token(user_id, user[2])
+            logger.warning(
+                "Strava отклонила refresh_token пользователя %s, обновление прекращено: %s", user_id, e,
+                extra={"user_id": user_id},
+            )
+            return None
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error(
+                "Ошибка соединения при обновлении токена пользователя %s: %r", user_id, e,
+                extra={"user_id": user_id},
+            )
+            return None
+        if not access_token:
+            logger.error("Strava отказала в обновлении токена пользователя %s", user_id, extra={"user_id": user_id})
+            return None
+        await database.save_user_tokens(user_id, access_token, refresh_token, expires_at)
+        logger.info("Токен пользователя %s обновлён, действует до %s", user_id, expires_at, extra={"user_id": user_id})
+        return access_token
+
+    # Токен обновляет другой процесс: ждём, пока в базе появятся новые токены.
+    # Если не дождались, отдаём прежний access_token, пока он не истёк.
+    async def _wait_for_refresh(self, user):
+        deadline = time.monotonic() + min(TOKEN_REFRESH_WAIT, self.lease)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(TOKEN_REFRESH_POLL)
+            current = await database.get_user(user[0])
+            if current is None or not current[2]:
+                return None
+            if current[1:] != user[1:]:
+                return current[1]
+        _, access_token, _, expires_at = user
+        return access_token if expires_at is not None and expires_at > time.time() else None
+
+    # Действующий access_token пользователя; при необходимости обновляется
+    async def get_access_token(self, user_id):
+        user = await database.get_user(user_id)
+        if user is None:
+            return None
+        _, access_token, _, expires_at = user
+        if expires_at is not None and expires_at - self.margin <= time.time():
+            return await self.refresh(user_id)
+        return access_token
+
+    async def refresh_due(self):
+        now = time.time()
+        users = await database.get_users_expiring_before(now + self.margin + self.spread, now)
+        due = [user_id for user_id, expires_at in users if self._due_at(user_id, expires_at) <= now]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh_one(user_id):
+            async with semaphore:
+                await self.refresh(user_id)
+
+        await asyncio.gather(*(refresh_one(user_id) for user_id in due))
+        return len(due)
+
+    async def _loop(self):
+        while True:
+            try:
+                refreshed = await self.refresh_due()
+                if refreshed:
+                    logger.info(f"Обновлено токенов Strava: {refreshed}")
+            except Exception:
+                logger.exception("Ошибка планировщика обновления токенов")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Общий планировщик для всего приложения
+token_refresher = TokenRefresher()
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import random
+import logging
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Доля трассировок, спаны которых записываются (0 — только trace id в логах)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+# Файл экспорта спанов в формате JSON Lines (можно отдавать коллектору, читающему файлы)
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH', 'traces.jsonl')
+# Спаны пишутся в файл пачками по TRACE_FLUSH_SPANS штук
+TRACE_FLUSH_SPANS = int(os.environ.get('TRACE_FLUSH_SPANS', 100))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+# Запись завершённых спанов в файл пачками
+class FileExporter:
+    def __init__(self, path=TRACE_EXPORT_PATH, flush_every=TRACE_FLUSH_SPANS):
+        self.path = path
+        self.flush_every = flush_every
+        self._buffer = []
+
+    def export(self, record):
+        self._buffer.append(json.dumps(record, ensure_ascii=False, default=str))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            logger.error(f"Не удалось записать спаны в {self.path}: {e!r}")
+
+
+exporter = FileExporter()
+
+
+# Участок работы внутри трассировки. Текущий спан хранится в contextvars,
+# поэтому задачи, созданные внутри спана, становятся его потомками.
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "attributes",
+                 "start", "_started", "_token")
+
+    def __init__(self, name, trace_id, parent_id, sampled, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    # begin()/end() — для случаев, когда начало и конец спана в разных функциях
+    # (хуки before_request/after_request); в остальных случаях — with
+    def begin(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def end(self, exc=None):
+        duration = time.perf_counter() - self._started
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        if self.sampled:
+            exporter.export({
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": round(duration * 1000, 3),
+                "attributes": self.attributes,
+            })
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+
+# Заглушка для спанов вне записываемой трассировки: ничего не измеряет и не пишет
+class _NoopSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# Начало трассировки (входящий запрос, обновление, событие).
+# Trace id появляется в логах всегда, спаны записываются с вероятностью sample_rate.
+def start_trace(name, sample_rate=None, **attributes):
+    rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    sampled = rate > 0 and random.random() < rate
+    return Span(name, f"{random.getrandbits(64):016x}", None, sampled, attributes)
+
+
+# Вложенный спан текущей трассировки; вне записываемой трассировки почти ничего не стоит
+def span(name, **attributes):
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, True, attributes)
+
+
+def current_span():
+    return _current_span.get()
+
+
+# Продолжение трассировки в другой задаче (например, обновление из очереди вебхука):
+# новый спан в той же трассировке, что и parent, или новая трассировка, если parent нет
+def continue_trace(parent, name, **attributes):
+    if parent is None:
+        return start_trace(name, **attributes)
+    return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+
+def current_trace_id():
+    current = _current_span.get()
+    return current.trace_id if current is not None else "-"
+
+
+# Фильтр логов, добавляющий trace_id в запись (для формата с %(trace_id)s)
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = current_trace_id()
+        return True
+
+
+def flush():
+    exporter.flush()